@@ -1,12 +1,145 @@
 import json
+import os
+import threading
 
-from flask import Flask, request, send_file
+import metrics
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
 from indexer_whoosh import Indexer
+from jobs import JobManager
+from pdf_pages import PdfPages, parse_pages
+from termcolor import colored
 
 app = Flask(__name__)
 CORS(app)
-indexer = Indexer("docs", "index-directory")
+# searches slower than SLOW_QUERY_SECONDS are logged to SLOW_QUERY_LOG, or
+# printed if it's not set, documents are split into INDEX_SHARDS indexes and
+# their content is kept outside the index if STORE_CONTENT is false
+indexer = Indexer(
+    "docs",
+    "index-directory",
+    store_content=os.environ.get("STORE_CONTENT", "true").lower() != "false",
+    slow_query_seconds=float(os.environ.get("SLOW_QUERY_SECONDS", 1)),
+    slow_query_log=os.environ.get("SLOW_QUERY_LOG"),
+    shards=int(os.environ.get("INDEX_SHARDS", 1)),
+)
+jobs = JobManager("index-directory/jobs")
+# excerpts of pdf files are kept up to PDF_PAGES_CACHE_MB
+pdf_pages = PdfPages(
+    "index-directory/pages",
+    int(os.environ.get("PDF_PAGES_CACHE_MB", 512)) * 2**20,
+)
+# cleared while the server warms up, see serve.py
+ready = threading.Event()
+ready.set()
+
+
+def warm_up():
+    """
+    Warms up the indexer with the searches listed in the json file in
+    WARMUP_QUERIES, if any, then reports the server as ready.
+    """
+    ready.clear()
+    try:
+        queries = []
+        if os.environ.get("WARMUP_QUERIES"):
+            with open(os.environ["WARMUP_QUERIES"], "r") as f:
+                queries = json.load(f)
+        indexer.warm_up(queries)
+    except Exception as e:
+        # a server without an index yet is still able to create it
+        print(colored(f"Warm up failed: {e}", "red"))
+    finally:
+        ready.set()
+
+
+def start_warm_up():
+    """Warms up the indexer in the background, reporting the server as not
+    ready until it's done."""
+    ready.clear()
+    threading.Thread(target=warm_up, daemon=True).start()
+
+
+def get_pagination():
+    """
+    Gets the page and page size arguments of the request.
+
+    :return: tuple with the page, None if not given, and the page size
+    """
+    page = request.args.get("page")
+    page_size = request.args.get("page_size", "20")
+    try:
+        page = None if page is None else int(page)
+        page_size = int(page_size)
+    except ValueError:
+        raise ValueError("page and page_size must be integers")
+    if page is not None and page < 1 or page_size < 1:
+        raise ValueError("page and page_size must be at least 1")
+    return page, page_size
+
+
+def get_batch_queries():
+    """
+    Gets the queries of a batch of searches from the body of the request.
+
+    :return: list of queries
+    """
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        raise ValueError("body must be a json list of queries")
+    for query in queries:
+        if not isinstance(query, dict):
+            raise ValueError("queries must be json objects")
+        # searches for tags are the only ones without terms to be found
+        if "TAG" not in query and "AND" not in query:
+            raise ValueError("queries must have 'AND' or 'TAG'")
+    return queries
+
+
+def search(query, terms=True, advanced=False):
+    """
+    Performs a search with the pagination, filtering, facets, fuzzy and
+    streaming arguments of the request.
+
+    :param query: query arguments
+    :param terms: whether to perform a search by terms within the documents
+    :param advanced: whether to perform an advanced search in the documents
+    :return: result of search, as json or streamed as newline delimited json
+    """
+    query = json.dumps(query)
+    try:
+        page, page_size = get_pagination()
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+    snippets = bool(request.args.get("snippets"))
+    filter_tags = request.args.get("filter")
+    filter_tags = filter_tags.split(",") if filter_tags else None
+    fuzzy = bool(request.args.get("fuzzy"))
+    if request.args.get("stream"):
+        results = indexer.iter_search_documents(
+            query,
+            terms,
+            advanced,
+            page,
+            page_size,
+            snippets,
+            filter_tags,
+            fuzzy,
+        )
+        lines = (json.dumps(r, ensure_ascii=False) + "\n" for r in results)
+        return Response(lines, mimetype="application/x-ndjson")
+    facets = bool(request.args.get("facets"))
+    return indexer.search_documents(
+        query,
+        terms,
+        advanced,
+        page,
+        page_size,
+        snippets,
+        filter_tags,
+        facets,
+        fuzzy,
+    )
 
 
 @app.route("/search/term")
@@ -19,8 +152,7 @@ def search_term():
     query = request.args.get("query")
     query = query.split(",")
     query = {"AND": query}
-    query = json.dumps(query)
-    return indexer.search_documents(query)
+    return search(query)
 
 
 @app.route("/search/tag")
@@ -32,8 +164,7 @@ def search_tag():
     """
     query = request.args.get("query")
     query = {"TAG": [query]}
-    query = json.dumps(query)
-    return indexer.search_documents(query, False)
+    return search(query, False)
 
 
 @app.route("/search/advanced")
@@ -51,8 +182,112 @@ def advanced_search():
         "OR": or_query.split(","),
         "NOT": not_query.split(","),
     }
-    query = json.dumps(query)
-    return indexer.search_documents(query, True, True)
+    return search(query, True, True)
+
+
+@app.route("/search/batch", methods=["POST"])
+def batch_search():
+    """
+    API endpoint for performing many searches on indexed files at once. The
+    body is a list of queries, searched for tags if they have 'TAG', as
+    advanced searches if they have 'OR' or 'NOT', and for terms otherwise.
+
+    :return: result of each search, in the same order
+    """
+    try:
+        queries = json.dumps(get_batch_queries())
+        page, page_size = get_pagination()
+    except ValueError as e:
+        return json.dumps({"error": str(e)}), 400
+    return indexer.search_documents_batch(queries, page, page_size)
+
+
+@app.route("/sync")
+def sync():
+    """
+    API endpoint for updating the index with modified, removed and new
+    files.
+
+    :return: result of indexing, or id of the background job
+    """
+    folder_path = request.args.get("path")
+    allow_ocr = bool(request.args.get("ocr"))
+    if request.args.get("background"):
+        return submit_job(
+            "sync", indexer.sync_documents, folder_path, allow_ocr
+        )
+    job = jobs.run("sync", indexer.sync_documents, folder_path, allow_ocr)
+    if job is None:
+        return job_running()
+    if job.status == "done":
+        return "Files synchronized successfully"
+    return "Error synchronizing files"
+
+
+@app.route("/retag")
+def retag():
+    """
+    API endpoint for updating tags and categories of indexed files after the
+    vocabulary changed.
+
+    :return: result of tagging, or id of the background job
+    """
+    if request.args.get("background"):
+        return submit_job("retag", indexer.retag_documents)
+    job = jobs.run("retag", indexer.retag_documents)
+    if job is None:
+        return job_running()
+    if job.status == "done":
+        return "Files tagged successfully"
+    return "Error tagging files"
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    """
+    API endpoint for retrieving usage statistics of the search cache.
+
+    :return: cache statistics
+    """
+    return json.dumps(indexer.cache_stats())
+
+
+@app.route("/extraction/report")
+def extraction_report():
+    """
+    API endpoint for retrieving the files that failed, timed out or crashed
+    during the last text extraction.
+
+    :return: extraction report
+    """
+    report = indexer.extraction_report()
+    if report is None:
+        return json.dumps({"error": "No extraction report"}), 404
+    return json.dumps(report, ensure_ascii=False)
+
+
+@app.route("/health")
+def health():
+    """
+    API endpoint for checking if the server is ready to answer searches.
+
+    :return: readiness status, with status code 503 while warming up
+    """
+    if not ready.is_set():
+        return json.dumps({"status": "warming up"}), 503
+    return json.dumps({"status": "ready"})
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    API endpoint for retrieving extraction, indexing and search metrics.
+
+    :return: metrics in the Prometheus text format
+    """
+    return Response(
+        metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4"
+    )
 
 
 @app.route("/create")
@@ -60,9 +295,19 @@ def create():
     """
     API endpoint for indexing existing documents.
 
-    :return: result of indexing
+    :return: result of indexing, or id of the background job
     """
-    if indexer.create_searchable_data():
+    pipelined = bool(request.args.get("pipelined"))
+    if request.args.get("background"):
+        return submit_job(
+            "create", indexer.create_searchable_data, pipelined=pipelined
+        )
+    job = jobs.run(
+        "create", indexer.create_searchable_data, pipelined=pipelined
+    )
+    if job is None:
+        return job_running()
+    if job.status == "done":
         return "Indexing successful"
     return "Error indexing data"
 
@@ -72,25 +317,116 @@ def add_folder():
     """
     API endpoint for extracting text and indexing new files.
 
-    :return: result of indexing
+    :return: result of indexing, or id of the background job
     """
     folder_path = request.args.get("path")
     allow_ocr = bool(request.args.get("ocr"))
-    if indexer.add_documents_to_index(folder_path, allow_ocr):
+    by_page = bool(request.args.get("by_page"))
+    pipelined = bool(request.args.get("pipelined"))
+    if request.args.get("background"):
+        return submit_job(
+            "add/folder",
+            indexer.add_documents_to_index,
+            folder_path,
+            allow_ocr,
+            by_page,
+            pipelined=pipelined,
+        )
+    job = jobs.run(
+        "add/folder",
+        indexer.add_documents_to_index,
+        folder_path,
+        allow_ocr,
+        by_page,
+        pipelined=pipelined,
+    )
+    if job is None:
+        return job_running()
+    if job.status == "done":
         return "Files indexed successfully"
     return "Error indexing files"
 
 
+def submit_job(name, func, *args, **kwargs):
+    """
+    Starts an indexing operation in background.
+
+    :param name: name of the operation
+    :param func: operation to be run
+    :param args: arguments of the operation
+    :param kwargs: keyword arguments of the operation
+    :return: id of the job, or an error if another job is writing to the index
+    """
+    job = jobs.submit(name, func, *args, **kwargs)
+    if job is None:
+        return job_running()
+    return json.dumps({"job": job.id}), 202
+
+
+def job_running():
+    """
+    Answers an indexing request while another operation writes to the
+    index, in background or not.
+
+    :return: error with status code 409
+    """
+    return json.dumps({"error": "Another indexing job is running"}), 409
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """
+    API endpoint for retrieving status and progress of a background job.
+
+    :param job_id: id of the job
+    :return: job status
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return json.dumps({"error": "Job not found"}), 404
+    return json.dumps(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/cancel")
+def cancel_job(job_id):
+    """
+    API endpoint for cancelling a background job.
+
+    :param job_id: id of the job
+    :return: job status
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return json.dumps({"error": "Job not found"}), 404
+    job.cancel()
+    return json.dumps(job.to_dict())
+
+
 @app.route("/pdf")
 def pdf():
     """
-    API endpoint for retrieving pdf file.
+    API endpoint for retrieving pdf file, or only some of its pages. Pages
+    are either listed, e.g. 1,3-5, or the ones containing any of the terms.
+
+    Responses are conditional, answering unchanged files with 304 and ranges
+    of bytes with 206, so viewers load large files progressively.
 
     :return: pdf file
     """
     file_path = request.args.get("file")
+    pages = request.args.get("pages")
+    terms = request.args.get("terms")
     try:
-        return send_file(file_path, mimetype="application/pdf")
+        if terms:
+            pages = indexer.get_matching_pages(file_path, terms.split(","))
+        elif pages:
+            pages = parse_pages(pages)
+        # without matching pages the whole file is returned
+        if pages:
+            file_path = os.path.abspath(pdf_pages.excerpt(file_path, pages))
+        return send_file(
+            file_path, mimetype="application/pdf", conditional=True
+        )
     except Exception as e:
         return str(e)
 
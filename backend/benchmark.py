@@ -0,0 +1,386 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unicodedata
+
+from catalog import Catalog
+from indexer_whoosh import Indexer
+from whoosh.lang import stopwords_for_language
+
+# syllables used to build words that look like portuguese, with accents
+# fmt: off
+SYLLABLES = [
+    "ba", "ca", "ção", "ções", "da", "de", "é", "fa", "gá", "gue", "í", "la",
+    "lhe", "ma", "mé", "na", "nhe", "ni", "ó", "pe", "pré", "qui", "ra",
+    "re", "rô", "sa", "são", "sé", "ta", "te", "tó", "tu", "ú", "va", "vi",
+    "xi", "zê",
+]
+# fmt: on
+
+# categories of the generated tags, the first ones use a frequency threshold
+CATEGORIES = ["assunto", "escala", "local", "periodo"]
+
+
+def strip_accents(text):
+    """
+    Removes accentuation of a text.
+
+    :param text: text
+    :return: text without accents
+    """
+    text = unicodedata.normalize("NFD", text)
+    return "".join(c for c in text if unicodedata.category(c) != "Mn")
+
+
+def generate_word(rng):
+    """
+    Generates a word from portuguese syllables.
+
+    :param rng: random number generator
+    :return: word
+    """
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def generate_vocabulary(rng, tags, keywords_per_tag):
+    """
+    Generates tags, their categories and the keywords associated with them.
+
+    :param rng: random number generator
+    :param tags: number of tags
+    :param keywords_per_tag: number of keywords of each tag
+    :return: tuple with keywords by tag, category by tag and accented form of each keyword
+    """
+    keywords, categories, accented = {}, {}, {}
+    while len(keywords) < tags:
+        tag = strip_accents(generate_word(rng))
+        if tag in keywords:
+            continue
+        keywords[tag] = []
+        categories[tag] = rng.choice(CATEGORIES)
+        for _ in range(keywords_per_tag):
+            # keywords have one to three words
+            kw = " ".join(generate_word(rng) for _ in range(rng.randint(1, 3)))
+            keywords[tag].append(strip_accents(kw))
+            accented[strip_accents(kw)] = kw
+    return keywords, categories, accented
+
+
+def generate_document(rng, words, stopwords, keywords, size, density):
+    """
+    Generates the text of a document.
+
+    :param rng: random number generator
+    :param words: common words of the corpus
+    :param stopwords: portuguese stopwords
+    :param keywords: accented keywords that can be planted in the text
+    :param size: number of words of the document
+    :param density: fraction of the words that are planted keywords
+    :return: document text
+    """
+    tokens = []
+    for i in range(size):
+        r = rng.random()
+        if r < density:
+            tokens.append(rng.choice(keywords))
+        elif r < 0.4:
+            tokens.append(rng.choice(stopwords))
+        else:
+            tokens.append(rng.choice(words))
+        if rng.random() < 0.05:
+            tokens[-1] = tokens[-1].capitalize()
+        if rng.random() < 0.08:
+            tokens[-1] += rng.choice([",", ".", ";", ":"])
+        if i % 15 == 14:
+            tokens.append("\n")
+    return " ".join(tokens)
+
+
+def generate_corpus(folder, size, args):
+    """
+    Generates the vocabulary files and the text of the documents of a
+    corpus.
+
+    :param folder: path where the corpus will be created
+    :param size: number of documents
+    :param args: benchmark arguments
+    :return: tuple with the tags, accented keywords, common words and documents of the corpus
+    """
+    rng = random.Random(args.seed)
+    keywords, categories, accented = generate_vocabulary(
+        rng, args.tags, args.keywords_per_tag
+    )
+    os.makedirs(f"{folder}/keywords")
+    os.makedirs(f"{folder}/docs")
+    with open(f"{folder}/keywords/benchmark.json", "w") as f:
+        json.dump(keywords, f, ensure_ascii=False)
+    with open(f"{folder}/tags.json", "w") as f:
+        json.dump(categories, f, ensure_ascii=False)
+    words = [generate_word(rng) for _ in range(args.words)]
+    stopwords = sorted(stopwords_for_language("por"))
+    documents = []
+    for i in range(size):
+        text = generate_document(
+            rng,
+            words,
+            stopwords,
+            list(accented.values()),
+            args.document_size,
+            args.density,
+        )
+        name = f"documento_{i}.pdf"
+        txt_path = f"docs/{name}.txt"
+        with open(f"{folder}/{txt_path}", "w") as f:
+            f.write(text)
+        documents.append((name, f"/benchmark/{name}", txt_path))
+    return list(keywords), list(accented.values()), words, documents
+
+
+def generate_queries(rng, tags, keywords, words, count):
+    """
+    Generates queries of each type of search.
+
+    :param rng: random number generator
+    :param tags: tags of the corpus
+    :param keywords: accented keywords of the corpus
+    :param words: common words of the corpus
+    :param count: number of queries of each type
+    :return: dictionary with the json queries of each type of search
+    """
+    terms = keywords + words
+    return {
+        "term": [
+            {"AND": rng.sample(terms, rng.randint(1, 2))} for _ in range(count)
+        ],
+        "tag": [{"TAG": [rng.choice(tags)]} for _ in range(count)],
+        "advanced": [
+            {
+                "AND": [rng.choice(keywords)],
+                "OR": rng.sample(terms, 2),
+                "NOT": [rng.choice(words)],
+            }
+            for _ in range(count)
+        ],
+    }
+
+
+def percentile(values, p):
+    """
+    Gets a percentile of values, by nearest rank.
+
+    :param values: list of values
+    :param p: percentile, from 0 to 100
+    :return: value at the percentile
+    """
+    values = sorted(values)
+    rank = max(int(round(p / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def folder_size(folder, exclude=()):
+    """
+    Gets the size of the files in a folder.
+
+    :param folder: path to the folder
+    :param exclude: prefixes of file names to ignore
+    :return: size in bytes
+    """
+    size = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if not name.startswith(tuple(exclude)):
+                size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def benchmark_tagging(indexer, documents):
+    """
+    Measures the throughput of inferring tags and categories of documents.
+
+    :param indexer: indexer holding the vocabulary
+    :param documents: documents of the corpus
+    :return: dictionary with the tagging measures
+    """
+    contents = []
+    for _, _, txt_path in documents:
+        with open(txt_path, "r") as f:
+            contents.append(indexer._process_content(f.read()))
+    start = time.perf_counter()
+    for content in contents:
+        indexer._get_file_tags_categories(content)
+    elapsed = time.perf_counter() - start
+    size = sum(len(c.encode("utf-8")) for c in contents)
+    return {
+        "seconds": elapsed,
+        "documents_per_second": len(contents) / elapsed,
+        "mb_per_second": size / elapsed / 2**20,
+    }
+
+
+def benchmark_indexing(indexer, documents):
+    """
+    Measures the time to index the documents of the corpus and the size of
+    the resulting index.
+
+    :param indexer: indexer of the corpus
+    :param documents: documents of the corpus
+    :return: dictionary with the indexing measures
+    """
+    # creates an empty index, then registers the documents to be added
+    indexer.create_searchable_data()
+    catalog = Catalog("index-directory")
+    for document in documents:
+        catalog.add(*document)
+    start = time.perf_counter()
+    success = indexer.add_documents_to_index()
+    elapsed = time.perf_counter() - start
+    return {
+        "success": success,
+        "seconds": elapsed,
+        "documents_per_second": len(documents) / elapsed,
+        "index_bytes": folder_size(
+            "index-directory", exclude=["catalog.db", "documents."]
+        ),
+        "document_store_bytes": folder_size("index-directory/documents"),
+    }
+
+
+def benchmark_search(indexer, queries, repeat):
+    """
+    Measures the latency of each type of search, without the results cache.
+
+    :param indexer: indexer of the corpus
+    :param queries: json queries of each type of search
+    :param repeat: number of times each query is run
+    :return: dictionary with the latency measures of each type of search
+    """
+    options = {
+        "term": (True, False),
+        "tag": (False, False),
+        "advanced": (True, True),
+    }
+    results = {}
+    for kind, kind_queries in queries.items():
+        terms, advanced = options[kind]
+        latencies, hits = [], 0
+        for query in kind_queries:
+            query_str = json.dumps(query)
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = indexer.search_documents(query_str, terms, advanced)
+                latencies.append(time.perf_counter() - start)
+            hits += len(json.loads(result)["results"])
+        results[kind] = {
+            "queries": len(latencies),
+            "mean_hits": hits / len(kind_queries),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000,
+        }
+    return results
+
+
+def run(size, args):
+    """
+    Generates a corpus and runs every benchmark on it.
+
+    :param size: number of documents of the corpus
+    :param args: benchmark arguments
+    :return: dictionary with the benchmark results
+    """
+    folder = tempfile.mkdtemp(prefix="deepdoc-benchmark-", dir=args.workdir)
+    cwd = os.getcwd()
+    # progress messages of the indexer are kept out of the results
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            return _run(folder, size, args)
+        finally:
+            os.chdir(cwd)
+            if not args.keep:
+                shutil.rmtree(folder, ignore_errors=True)
+
+
+def _run(folder, size, args):
+    """
+    Runs every benchmark on a generated corpus.
+
+    :param folder: path where the corpus will be created
+    :param size: number of documents of the corpus
+    :param args: benchmark arguments
+    :return: dictionary with the benchmark results
+    """
+    tags, keywords, words, documents = generate_corpus(folder, size, args)
+    # the indexer reads the vocabulary from the working directory
+    os.chdir(folder)
+    indexer = Indexer(
+        "docs",
+        "index-directory",
+        cache_size=0,
+        store_content=not args.no_store_content,
+        shards=args.shards,
+    )
+    rng = random.Random(args.seed + 1)
+    queries = generate_queries(rng, tags, keywords, words, args.queries)
+    return {
+        "corpus": {
+            "documents": len(documents),
+            "bytes": folder_size("docs"),
+            "keywords": len(set(keywords)),
+            "tags": len(tags),
+        },
+        "tagging": benchmark_tagging(indexer, documents),
+        "indexing": benchmark_indexing(indexer, documents),
+        "search": benchmark_search(indexer, queries, args.repeat),
+    }
+
+
+def parse_args():
+    """
+    Parses the benchmark arguments from the command line.
+
+    :return: benchmark arguments
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmarks tagging, indexing and search on a synthetic "
+        "portuguese corpus, printing the results as json."
+    )
+    parser.add_argument(
+        "--documents",
+        type=int,
+        nargs="+",
+        default=[200],
+        help="number of documents of each corpus to benchmark",
+    )
+    parser.add_argument("--document-size", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=5000)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--keywords-per-tag", type=int, default=10)
+    parser.add_argument("--density", type=float, default=0.01)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-store-content", action="store_true")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--workdir", help="where the corpus is generated")
+    parser.add_argument("--keep", action="store_true", help="keep the corpus")
+    parser.add_argument("--output", help="file to write results to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    runs = [run(size, args) for size in args.documents]
+    results = {"parameters": vars(args), "runs": runs}
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(0 if all(r["indexing"]["success"] for r in runs) else 1)
@@ -0,0 +1,359 @@
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+
+class Catalog:
+    def __init__(self, index_folder):
+        """
+        Class responsible for registering extracted and indexed documents, and
+        the text extracted from each pdf content, in an embedded database,
+        safe for concurrent use by worker processes.
+
+        Documents registered in a legacy indexed_files.csv are migrated on
+        first use.
+
+        :param index_folder: path where the index is located
+        """
+        self._index_folder = index_folder
+        self._path = f"{self._index_folder}/catalog.db"
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "pdf_path TEXT PRIMARY KEY, "
+                "name TEXT NOT NULL, "
+                "txt_path TEXT NOT NULL, "
+                "indexed INTEGER NOT NULL DEFAULT 0, "
+                "hash TEXT, "
+                "vocabulary TEXT)"
+            )
+            # catalogs created before documents kept the hash they were
+            # extracted from and the vocabulary they were tagged with
+            columns = [
+                row[1] for row in conn.execute("PRAGMA table_info(documents)")
+            ]
+            for column in ["hash", "vocabulary"]:
+                if column not in columns:
+                    conn.execute(
+                        f"ALTER TABLE documents ADD COLUMN {column} TEXT"
+                    )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS documents_name ON documents (name)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS documents_indexed "
+                "ON documents (indexed)"
+            )
+            # content hash of pdf files, size and mtime avoid rehashing
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "pdf_path TEXT PRIMARY KEY, "
+                "size INTEGER NOT NULL, "
+                "mtime REAL NOT NULL, "
+                "hash TEXT NOT NULL)"
+            )
+            # extracted text of pdf files, by content hash
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                "hash TEXT PRIMARY KEY, "
+                "method TEXT NOT NULL, "
+                "valid INTEGER NOT NULL, "
+                "text BLOB NOT NULL)"
+            )
+            # vocabularies documents were tagged with, by fingerprint
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS vocabularies ("
+                "fingerprint TEXT PRIMARY KEY, "
+                "vocabulary TEXT NOT NULL)"
+            )
+        self._migrate_csv()
+
+    def __getstate__(self):
+        # connections can't be shared with other processes
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def add(self, name, pdf_path, txt_path, file_hash=None):
+        """
+        Registers an extracted document, pending indexation.
+
+        :param name: name of the document
+        :param pdf_path: path to the original pdf file
+        :param txt_path: path to the file containing text from the pdf
+        :param file_hash: content hash of the pdf file the text was extracted from
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO documents "
+                "(pdf_path, name, txt_path, indexed, hash) "
+                "VALUES (?, ?, ?, 0, ?)",
+                (pdf_path, name, txt_path, file_hash),
+            )
+
+    def remove(self, pdf_paths):
+        """
+        Unregisters documents.
+
+        :param pdf_paths: paths to the original pdf files
+        """
+        with self._connection() as conn:
+            conn.executemany(
+                "DELETE FROM documents WHERE pdf_path = ?",
+                [(p,) for p in pdf_paths],
+            )
+            conn.executemany(
+                "DELETE FROM files WHERE pdf_path = ?",
+                [(p,) for p in pdf_paths],
+            )
+
+    def set_hash(self, pdf_path, file_hash):
+        """
+        Updates the content hash a document was extracted from.
+
+        :param pdf_path: path to the original pdf file
+        :param file_hash: content hash of the pdf file
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE documents SET hash = ? WHERE pdf_path = ?",
+                (file_hash, pdf_path),
+            )
+
+    def documents(self):
+        """
+        Gets every registered document.
+
+        :return: list of document rows
+        """
+        return self._connection().execute("SELECT * FROM documents").fetchall()
+
+    def get(self, pdf_path):
+        """
+        Gets a registered document by its pdf path.
+
+        :param pdf_path: path to the original pdf file
+        :return: document row or None if not registered
+        """
+        return (
+            self._connection()
+            .execute("SELECT * FROM documents WHERE pdf_path = ?", (pdf_path,))
+            .fetchone()
+        )
+
+    def get_by_name(self, name):
+        """
+        Gets registered documents by name.
+
+        :param name: name of the document
+        :return: list of document rows
+        """
+        return (
+            self._connection()
+            .execute("SELECT * FROM documents WHERE name = ?", (name,))
+            .fetchall()
+        )
+
+    def pdf_paths(self):
+        """
+        Gets the pdf paths of every registered document.
+
+        :return: set of pdf paths
+        """
+        rows = self._connection().execute("SELECT pdf_path FROM documents")
+        return {row["pdf_path"] for row in rows}
+
+    def pending(self):
+        """
+        Gets every document not yet indexed.
+
+        :return: list of document rows
+        """
+        return (
+            self._connection()
+            .execute("SELECT * FROM documents WHERE indexed = 0")
+            .fetchall()
+        )
+
+    def mark_indexed(self, pdf_paths, indexed=True, vocabulary=None):
+        """
+        Updates the indexation state of documents.
+
+        :param pdf_paths: paths to the original pdf files
+        :param indexed: whether the documents are indexed
+        :param vocabulary: fingerprint of the vocabulary the documents were tagged with
+        """
+        with self._connection() as conn:
+            conn.executemany(
+                "UPDATE documents SET indexed = ?, "
+                "vocabulary = COALESCE(?, vocabulary) WHERE pdf_path = ?",
+                [(int(indexed), vocabulary, p) for p in pdf_paths],
+            )
+
+    def outdated_vocabulary(self, vocabulary):
+        """
+        Gets indexed documents tagged with a vocabulary other than the given
+        one.
+
+        :param vocabulary: fingerprint of the current vocabulary
+        :return: list of document rows
+        """
+        return (
+            self._connection()
+            .execute(
+                "SELECT * FROM documents WHERE indexed = 1 AND "
+                "(vocabulary IS NULL OR vocabulary != ?)",
+                (vocabulary,),
+            )
+            .fetchall()
+        )
+
+    def get_vocabulary(self, fingerprint):
+        """
+        Gets a vocabulary documents were tagged with.
+
+        :param fingerprint: fingerprint of the vocabulary
+        :return: dictionary with the keywords and tags of the vocabulary, or None if it's unknown
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT vocabulary FROM vocabularies WHERE fingerprint = ?",
+                (fingerprint,),
+            )
+            .fetchone()
+        )
+        return None if row is None else json.loads(row["vocabulary"])
+
+    def add_vocabulary(self, fingerprint, vocabulary):
+        """
+        Registers a vocabulary documents are tagged with.
+
+        :param fingerprint: fingerprint of the vocabulary
+        :param vocabulary: dictionary with the keywords and tags of the vocabulary
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO vocabularies (fingerprint, vocabulary) "
+                "VALUES (?, ?)",
+                (fingerprint, json.dumps(vocabulary)),
+            )
+
+    def reset_indexed(self):
+        """Marks every document as not indexed."""
+        with self._connection() as conn:
+            conn.execute("UPDATE documents SET indexed = 0")
+
+    def file_hash(self, pdf_path):
+        """
+        Gets the content hash of a pdf file, only reading the file if its size
+        or modification time changed since it was last hashed.
+
+        :param pdf_path: path to the pdf file
+        :return: sha256 hex digest of the file
+        """
+        stat = os.stat(pdf_path)
+        row = (
+            self._connection()
+            .execute("SELECT * FROM files WHERE pdf_path = ?", (pdf_path,))
+            .fetchone()
+        )
+        if (
+            row
+            and row["size"] == stat.st_size
+            and row["mtime"] == stat.st_mtime
+        ):
+            return row["hash"]
+        digest = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        file_hash = digest.hexdigest()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files (pdf_path, size, mtime, hash) "
+                "VALUES (?, ?, ?, ?)",
+                (pdf_path, stat.st_size, stat.st_mtime, file_hash),
+            )
+        return file_hash
+
+    def get_extraction(self, file_hash):
+        """
+        Gets the text previously extracted from a pdf file.
+
+        :param file_hash: content hash of the pdf file
+        :return: tuple with text, extraction method and whether the text is valid, or None if never extracted
+        """
+        row = (
+            self._connection()
+            .execute("SELECT * FROM extractions WHERE hash = ?", (file_hash,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        text = zlib.decompress(row["text"]).decode("utf-8")
+        return text, row["method"], bool(row["valid"])
+
+    def add_extraction(self, file_hash, text, method, valid):
+        """
+        Registers the text extracted from a pdf file.
+
+        :param file_hash: content hash of the pdf file
+        :param text: extracted text
+        :param method: extraction method, plain or tesseract
+        :param valid: whether the extracted text is valid
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO extractions "
+                "(hash, method, valid, text) VALUES (?, ?, ?, ?)",
+                (
+                    file_hash,
+                    method,
+                    int(valid),
+                    zlib.compress(text.encode("utf-8")),
+                ),
+            )
+
+    def _connection(self):
+        """
+        Gets the database connection of the current thread and process.
+
+        :return: sqlite connection
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            # lets readers work while a worker is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _migrate_csv(self):
+        """Imports documents registered in a legacy indexed_files.csv."""
+        csv_path = f"{self._index_folder}/indexed_files.csv"
+        if not os.path.exists(csv_path):
+            return
+        with open(csv_path, "r") as f:
+            rows = [
+                (r["pdf_path"], r["name"], r["txt_path"], int(r["indexed"]))
+                for r in csv.DictReader(f)
+            ]
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO documents "
+                "(pdf_path, name, txt_path, indexed) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        os.rename(csv_path, f"{csv_path}.migrated")
@@ -0,0 +1,293 @@
+import json
+import mmap
+import os
+import threading
+import zlib
+from glob import glob
+
+
+class DocumentStore:
+    def __init__(self, folder):
+        """
+        Class responsible for keeping documents content compressed outside the
+        index, in an append-only data file read through a memory map.
+
+        Each record is the zlib compressed content of a document, located by
+        an offsets file where every line registers the latest record of a
+        document id.
+
+        Files are never truncated, as other processes may be reading them.
+        Clearing or compacting the store writes the files of a new
+        generation, named by a pointer file replaced at once, and readers
+        switch to it on their next access.
+
+        :param folder: path where the store files will be created
+        """
+        self._folder = folder
+        self._pointer_path = f"{folder}/documents.generation"
+        self._lock = threading.Lock()
+        self._generation = None
+        self._pointer_version = None
+        self._offsets = {}
+        self._offsets_read = 0
+        self._map = None
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        with self._lock:
+            if not os.path.exists(self._pointer_path):
+                # a store written before generations becomes the first one
+                legacy = [f"{folder}/documents.dat", f"{folder}/documents.idx"]
+                for old, new in zip(legacy, self._paths(1)):
+                    if os.path.exists(old):
+                        os.replace(old, new)
+                self._switch(1)
+            self._check_generation()
+
+    def put(self, doc_id, content):
+        """
+        Stores the content of a document, replacing any previous one.
+
+        :param doc_id: id of the document
+        :param content: document content
+        """
+        self.register([self.append(doc_id, content)])
+
+    def delete(self, doc_id):
+        """
+        Removes the content of a document.
+
+        :param doc_id: id of the document
+        """
+        self.register([self.removal(doc_id)])
+
+    def append(self, doc_id, content):
+        """
+        Writes the content of a document, which is only read once its
+        location is registered.
+
+        :param doc_id: id of the document
+        :param content: document content
+        :return: location of the content, see register
+        """
+        data = zlib.compress(content.encode("utf-8"))
+        with self._lock:
+            self._check_generation()
+            with open(self._data_path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            return self._generation, doc_id, offset, len(data)
+
+    def removal(self, doc_id):
+        """
+        Gets the location removing the content of a document once
+        registered.
+
+        :param doc_id: id of the document
+        :return: location of no content, see register
+        """
+        # removals don't refer to the data file of any generation
+        return None, doc_id, -1, 0
+
+    def register(self, locations):
+        """
+        Makes contents written and removals take effect, replacing the
+        previous content of their documents.
+
+        :param locations: locations returned by append or removal
+        """
+        with self._lock:
+            self._check_generation()
+            for generation, doc_id, _, _ in locations:
+                if generation not in (None, self._generation):
+                    raise ValueError(
+                        f"Content of {doc_id} was written to a store "
+                        "cleared or compacted since"
+                    )
+            self._append_offsets(
+                [
+                    {"id": doc_id, "offset": offset, "length": length}
+                    for _, doc_id, offset, length in locations
+                ]
+            )
+
+    def get(self, doc_id):
+        """
+        Gets the content of a document.
+
+        :param doc_id: id of the document
+        :return: document content, or None if it's not stored
+        """
+        with self._lock:
+            try:
+                data = self._read(doc_id)
+            except FileNotFoundError:
+                # files removed since the generation was checked belong to a
+                # store cleared or compacted by another process
+                data = self._read(doc_id)
+        if data is None:
+            return None
+        return zlib.decompress(data).decode("utf-8")
+
+    def clear(self):
+        """Removes every document."""
+        with self._lock:
+            self._switch(self._current_generation() + 1)
+            self._check_generation()
+
+    def compact(self, max_waste=0.0):
+        """
+        Rewrites the store keeping only the latest content of each document,
+        if enough of it is taken by replaced or deleted content.
+
+        :param max_waste: share of the data file that may be wasted without rewriting it
+        """
+        with self._lock:
+            self._check_generation()
+            self._read_offsets()
+            size = os.path.getsize(self._data_path)
+            used = sum(length for _, length in self._offsets.values())
+            if not size or (size - used) / size <= max_waste:
+                return
+            self._remap()
+            generation = self._current_generation() + 1
+            data_path, offsets_path = self._paths(generation)
+            with open(data_path, "wb") as data, open(offsets_path, "w") as idx:
+                for doc_id, (offset, length) in self._offsets.items():
+                    record = {
+                        "id": doc_id,
+                        "offset": data.tell(),
+                        "length": length,
+                    }
+                    data.write(self._map[offset : offset + length])
+                    print(json.dumps(record, ensure_ascii=False), file=idx)
+            self._switch(generation)
+            self._check_generation()
+
+    def _read(self, doc_id):
+        """
+        Reads the latest record of a document.
+
+        :param doc_id: id of the document
+        :return: compressed document content, or None if it's not stored
+        """
+        self._check_generation()
+        self._read_offsets()
+        location = self._offsets.get(doc_id)
+        if location is None:
+            return None
+        offset, length = location
+        if self._map is None or len(self._map) < offset + length:
+            self._remap()
+        return self._map[offset : offset + length]
+
+    def _paths(self, generation):
+        """
+        Gets the files of a generation of the store.
+
+        :param generation: generation number
+        :return: tuple with the paths of the data and offsets files
+        """
+        prefix = f"{self._folder}/documents.{generation}"
+        return f"{prefix}.dat", f"{prefix}.idx"
+
+    def _current_generation(self):
+        """
+        Reads the generation of the store in use.
+
+        :return: generation number
+        """
+        with open(self._pointer_path, "r") as f:
+            return int(f.read())
+
+    def _switch(self, generation):
+        """
+        Makes a generation the one in use, creating its files if needed, and
+        removes the files of the others.
+
+        :param generation: generation number
+        """
+        for path in self._paths(generation):
+            open(path, "ab").close()
+        tmp_path = f"{self._pointer_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(generation))
+        os.replace(tmp_path, self._pointer_path)
+        # memory maps of removed files stay valid for the readers using them
+        current = set(self._paths(generation))
+        for path in glob(f"{self._folder}/documents.*.dat") + glob(
+            f"{self._folder}/documents.*.idx"
+        ):
+            if path not in current:
+                os.remove(path)
+
+    def _check_generation(self):
+        """Starts reading the generation in use if the store was cleared or
+        compacted since the last access, possibly by another process."""
+        stat = os.stat(self._pointer_path)
+        # the pointer file is replaced, never written in place
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if version == self._pointer_version:
+            return
+        self._pointer_version = version
+        generation = self._current_generation()
+        if generation == self._generation:
+            return
+        self._generation = generation
+        self._data_path, self._offsets_path = self._paths(generation)
+        self._close_map()
+        self._offsets = {}
+        self._offsets_read = 0
+
+    def _append_offsets(self, records):
+        """
+        Registers the location of the latest record of documents.
+
+        :param records: location records, with the id of the document, the position of the record in the data file, -1 if deleted, and its size
+        """
+        if not records:
+            return
+        self._read_offsets()
+        with open(self._offsets_path, "a") as f:
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False), file=f)
+        for record in records:
+            self._apply_offset(record)
+        self._offsets_read = os.path.getsize(self._offsets_path)
+
+    def _read_offsets(self):
+        """Reads locations registered since the last read, possibly by
+        another process."""
+        if os.path.getsize(self._offsets_path) == self._offsets_read:
+            return
+        with open(self._offsets_path, "r") as f:
+            f.seek(self._offsets_read)
+            for line in f:
+                # a line still being written by another process is read later
+                if not line.endswith("\n"):
+                    break
+                self._apply_offset(json.loads(line))
+                self._offsets_read += len(line.encode("utf-8"))
+
+    def _apply_offset(self, record):
+        """
+        Updates the location of a document.
+
+        :param record: location record
+        """
+        if record["offset"] < 0:
+            self._offsets.pop(record["id"], None)
+        else:
+            self._offsets[record["id"]] = (record["offset"], record["length"])
+
+    def _remap(self):
+        """Maps the data file again, after it has grown."""
+        self._close_map()
+        if os.path.getsize(self._data_path):
+            with open(self._data_path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        """Closes the memory map of the data file."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
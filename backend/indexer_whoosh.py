@@ -1,28 +1,127 @@
+import hashlib
 import json
 import os
 import re
+import threading
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from glob import glob
+from itertools import chain
+from multiprocessing import Pool
 
-import numpy as np
-import pandas as pd
+import metrics
+from catalog import Catalog
+from document_store import DocumentStore
+from jobs import Progress
+from keyword_matcher import KeywordMatcher
+from query_cache import QueryCache
+from searcher_pool import SearcherPool
+from shards import ShardedWriter, shard_of
 from termcolor import colored
 from text_from_pdf import TextFromPDF
+from trigram_index import TrigramIndex
 from whoosh.analysis import RegexTokenizer, StopFilter
 from whoosh.fields import ID, KEYWORD, STORED, TEXT, Schema
-from whoosh.index import create_in, open_dir
+from whoosh.index import TOC, create_in, exists_in, open_dir
 from whoosh.qparser import QueryParser
-from whoosh.scoring import Frequency
+from whoosh.query import And, AndMaybe, AndNot, NullQuery, Or, Term
+from whoosh.query.spans import SpanNear2, SpanOr
+
+# maximum number of documents waiting to be tagged in a pipelined indexation
+PIPELINE_QUEUE_SIZE = 64
+# seconds between checks of a pipeline left while waiting for a slot
+PIPELINE_WAIT_SECONDS = 0.1
+
+# number of distinct terms from which a batch of searches counts them all in
+# a single pass over each document, instead of a scan for each term
+BATCH_MATCHER_MIN_TERMS = 64
+
+# maximum number of close variants of a word in a fuzzy search, and of
+# variants of every word of a query
+FUZZY_MAX_VARIANTS = 8
+FUZZY_MAX_EXPANSIONS = 64
+
+# share of the document store taken by replaced or deleted content from
+# which it's compacted after documents are updated
+DOCUMENT_STORE_MAX_WASTE = 0.5
+
+# indexer used by tagging workers, set when the worker process starts
+_worker_indexer = None
+
+
+def _init_tagging_worker(indexer):
+    """
+    Sets the indexer used by a tagging worker.
+
+    :param indexer: indexer holding the vocabulary
+    """
+    global _worker_indexer
+    _worker_indexer = indexer
+    metrics.init_worker()
+
+
+def _tag_document(document):
+    """
+    Tags a document in a worker process.
+
+    :param document: document to be tagged
+    :return: tuple with the document with its processed content, tags and categories, and the metrics recorded
+    """
+    return metrics.collect(_worker_indexer._tag_document, document)
+
+
+class _PipelineProgress(Progress):
+    def __init__(self, progress, pending):
+        """
+        Class responsible for reporting the progress of a pipelined
+        indexation, where extracted documents are tagged and indexed along
+        with the pending ones, so their totals are known once extraction
+        starts.
+
+        :param progress: receives the number of documents processed by each stage
+        :param pending: number of documents extracted before the indexation
+        """
+        self._progress = progress
+        self._pending = pending
+        for stage in ["tagged", "indexed"]:
+            progress.start(stage, pending)
+
+    def start(self, stage, total):
+        self._progress.start(stage, total)
+        if stage == "extracted":
+            for stage in ["tagged", "indexed"]:
+                self._progress.start(stage, self._pending + total)
+
+    def advance(self, stage, count=1):
+        self._progress.advance(stage, count)
 
 
 class Indexer:
-    def __init__(self, documents_folder, index_folder):
+    def __init__(
+        self,
+        documents_folder,
+        index_folder,
+        cache_size=256,
+        cache_ttl=300,
+        store_content=True,
+        slow_query_seconds=None,
+        slow_query_log=None,
+        shards=1,
+    ):
         """
         Class responsible for handling indexation, tagging and search of
         documents.
 
         :param documents_folder: path where files containing text from pdfs will be saved
         :param index_folder: path where the index will be created
+        :param cache_size: maximum number of search results kept in cache
+        :param cache_ttl: seconds a search result is kept in cache
+        :param store_content: whether to store documents content in the index, otherwise occurrences are counted from the index postings
+        :param slow_query_seconds: searches taking longer are logged, none are logged if None
+        :param slow_query_log: path of a file where slow searches are appended as json lines, printed if not given
+        :param shards: number of indexes documents are split into by the hash of their path, the index must be created again when it changes
         """
         self._keywords = {}
         for cat in glob("keywords/*.json"):
@@ -32,151 +131,1531 @@ class Indexer:
         with open("tags.json", "r") as f:
             self._tags = json.load(f)
         self._keywords_array = self._get_keywords_array()
-        self._writer = None
+        self._keywords_matcher = KeywordMatcher(self._keywords_array)
+        self._keywords_order = {
+            kw: i for i, kw in enumerate(self._keywords_matcher.keywords)
+        }
+        self._vocabulary = self._get_vocabulary_fingerprint()
+        # breaks text into tokens and remove portuguese stopwords
+        self._analyzer = RegexTokenizer() | StopFilter(lang="por")
         self._index_folder = index_folder
+        # a single shard is kept in the index folder itself
+        self._shards = [
+            SearcherPool(folder) for folder in self._get_shard_folders(shards)
+        ]
+        # documents of each tag and category by shard, with the generation
+        # they were read from
+        self._tag_documents = {}
+        # trigram index of the content vocabulary by shard, with the
+        # generation it was read from
+        self._trigram_indexes = {}
+        # searches fan out to every shard concurrently
+        self._executor = ThreadPoolExecutor(shards) if shards > 1 else None
+        self._cache = QueryCache(cache_size, cache_ttl)
+        self._store_content = store_content
+        self._slow_query_seconds = slow_query_seconds
+        self._slow_query_log = slow_query_log
+        self._slow_query_lock = threading.Lock()
         self._text_extractor = TextFromPDF(
             documents_folder, self._index_folder
         )
+        self._catalog = Catalog(self._index_folder)
+        # content of documents when it's not stored in the index
+        self._documents = DocumentStore(f"{self._index_folder}/documents")
 
-    def create_searchable_data(self):
-        """Creates index schema and indexes existing documents."""
-        # breaks text into tokens and remove portuguese stopwords
-        analyzer = RegexTokenizer() | StopFilter(lang="por")
+    def create_searchable_data(self, progress=None, pipelined=False):
+        """
+        Creates index schema and indexes existing documents.
+
+        :param progress: receives the number of documents processed by each stage
+        :param pipelined: whether to tag documents in parallel while indexing
+        :return: if indexing process was successful
+        """
         # schema for file indexing
         # title: title of the document, # path: path to the document
         # content: text from the document, # tags: tags of the document
         # categories: tags from document grouped in corresponding categories
+        # positions of content terms are always indexed, so occurrences can
+        # be counted from postings when content is not stored
         schema = Schema(
             title=TEXT(stored=True),
             path=ID(stored=True, unique=True),
-            content=TEXT(analyzer=analyzer, stored=True, phrase=True),
+            content=TEXT(
+                analyzer=self._analyzer,
+                stored=self._store_content,
+                phrase=True,
+            ),
             tags=KEYWORD(lowercase=True, commas=True),
             categories=STORED(),
         )
-        # creates index following schema on directory
-        create_in(f"{self._index_folder}", schema).close()
-        data = pd.read_csv(
-            f"{self._index_folder}/indexed_files.csv", index_col="name"
+        # creates index following schema on the directory of each shard
+        for folder in self._get_shard_folders(len(self._shards)):
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+            self._create_index(folder, schema)
+        # searchers, results and content from the previous index are no
+        # longer valid
+        for shard in self._shards:
+            shard.reset()
+        self._tag_documents.clear()
+        self._trigram_indexes.clear()
+        self._cache.clear()
+        self._documents.clear()
+        self._catalog.reset_indexed()
+        return self.add_documents_to_index(
+            progress=progress, pipelined=pipelined
         )
-        data["indexed"] = 0
-        data.to_csv(f"{self._index_folder}/indexed_files.csv")
-        return self.add_documents_to_index()
 
-    def add_documents_to_index(self, folder_path=None, allow_ocr=False):
+    def _create_index(self, folder, schema):
+        """
+        Creates an empty index, numbered after the generation of the index it
+        replaces, so processes holding the previous one notice it changed.
+
+        :param folder: path of the index
+        :param schema: schema of the index
+        """
+        replaced = None
+        if exists_in(folder):
+            replaced = open_dir(folder).latest_generation()
+        index = create_in(folder, schema)
+        if replaced is not None:
+            toc = TOC(schema, [], replaced + 1)
+            toc.write(index.storage, index.indexname)
+        index.close()
+
+    def add_documents_to_index(
+        self,
+        folder_path=None,
+        allow_ocr=False,
+        by_page=False,
+        progress=None,
+        pipelined=False,
+    ):
         """
         Indexes new documents.
 
         :param folder_path: path where to index documents from
         :param allow_ocr: if allowed to run OCR on documents
+        :param by_page: whether to extract text page by page
+        :param progress: receives the number of documents processed by each stage
+        :param pipelined: whether to tag and index documents while others are still being extracted
         :return: if indexing process was successful
         """
+        progress = progress or Progress()
+        if pipelined:
+            return self._add_documents_pipelined(
+                folder_path, allow_ocr, by_page, progress
+            )
         if folder_path:
-            self._text_extractor.extract_text_from_pdfs(folder_path, allow_ocr)
-        paths = self._get_all_file_paths()
-        ix = open_dir(f"{self._index_folder}")
+            self._text_extractor.extract_text_from_pdfs(
+                folder_path, allow_ocr, by_page, progress
+            )
+        documents = self._catalog.pending()
+        writer = None
         try:
             # opens index writer that will parallelize job
-            self._writer = ix.writer(procs=os.cpu_count(), limitmb=256)
-            self._add_to_writer(paths)
-            print("Committing indexes")
-            # commits new documents
-            self._writer.commit()
-            ix.close()
-            # register new indexed documents
-            file_names = [p.split("/")[-1][:-4] for p in paths]
-            data = pd.read_csv(
-                f"{self._index_folder}/indexed_files.csv", index_col="name"
-            )
-            data.loc[file_names, ["indexed"]] = 1
-            data.to_csv(f"{self._index_folder}/indexed_files.csv")
+            writer = self._open_writer(procs=os.cpu_count())
+            locations = self._add_to_writer(writer, documents, progress)
+            self._commit(
+                writer, [d["pdf_path"] for d in documents], progress, locations
+            )
             return True
         except Exception as e:
             print(colored(e, "red"))
-            # cancel documents indexation
-            self._writer.cancel()
-            ix.close()
+            # cancel documents indexation, only if this call opened the writer
+            if writer is not None and not writer.is_closed:
+                writer.cancel()
             return False
 
-    def search_documents(self, query_str, terms=True, advanced=False):
+    def _add_documents_pipelined(
+        self, folder_path, allow_ocr, by_page, progress
+    ):
+        """
+        Indexes new documents as a pipeline: extraction workers feed tagging
+        workers through a bounded queue, while a single writer indexes tagged
+        documents as they arrive.
+
+        :param folder_path: path where to index documents from
+        :param allow_ocr: if allowed to run OCR on documents
+        :param by_page: whether to extract text page by page
+        :param progress: receives the number of documents processed by each stage
+        :return: if indexing process was successful
+        """
+        documents = [dict(d) for d in self._catalog.pending()]
+        progress = _PipelineProgress(progress, len(documents))
+        if folder_path:
+            documents = chain(
+                documents,
+                self._text_extractor.iter_text_from_pdfs(
+                    folder_path, allow_ocr, by_page, progress
+                ),
+            )
+        # extraction stops when too many documents are waiting to be tagged
+        slots = threading.BoundedSemaphore(PIPELINE_QUEUE_SIZE)
+        # set when the pipeline is left, possibly before every document was
+        # tagged
+        stopped = threading.Event()
+
+        def bounded(documents):
+            for document in documents:
+                # runs in the task thread of the pool, which is waited for
+                # when the pool is terminated, so it can't wait for slots
+                # released by a loop that was left
+                while not slots.acquire(timeout=PIPELINE_WAIT_SECONDS):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                yield document
+
+        indexed = []
+        locations = []
+        writer = None
+        try:
+            # tagging is already parallel, so a single writer process is used
+            # by each shard
+            writer = self._open_writer()
+            with Pool(
+                os.cpu_count(),
+                initializer=_init_tagging_worker,
+                initargs=(self,),
+            ) as pool:
+                try:
+                    # metrics recorded by workers arrive with the documents
+                    for document, content, tags, categories in metrics.merged(
+                        pool.imap_unordered(_tag_document, bounded(documents))
+                    ):
+                        slots.release()
+                        progress.advance("tagged")
+                        location = self._add_document(
+                            writer, document, content, tags, categories
+                        )
+                        progress.advance("indexed")
+                        indexed.append(document["pdf_path"])
+                        locations.append(location)
+                finally:
+                    stopped.set()
+                    # wakes the task thread if it's waiting for a slot
+                    try:
+                        slots.release()
+                    except ValueError:
+                        pass
+            self._commit(writer, indexed, progress, locations)
+            return True
+        except Exception as e:
+            print(colored(e, "red"))
+            # cancel documents indexation, only if this call opened the writer
+            if writer is not None and not writer.is_closed:
+                writer.cancel()
+            return False
+
+    def sync_documents(self, folder_path=None, allow_ocr=False, progress=None):
+        """
+        Updates the index with documents whose pdf was modified or removed,
+        documents extracted again and new documents, without rebuilding it.
+
+        :param folder_path: path where to look for new documents
+        :param allow_ocr: if allowed to run OCR on documents
+        :param progress: receives the number of documents processed by each stage
+        :return: if indexing process was successful
+        """
+        progress = progress or Progress()
+        removed = []
+        modified = []
+        for document in self._catalog.documents():
+            pdf_path = document["pdf_path"]
+            if not os.path.exists(pdf_path):
+                removed.append(document)
+                continue
+            file_hash = self._catalog.file_hash(pdf_path)
+            if document["hash"] is None:
+                # documents registered before hashes were kept are assumed
+                # to be up to date
+                self._catalog.set_hash(pdf_path, file_hash)
+            elif document["hash"] != file_hash:
+                modified.append(pdf_path)
+        print(f"{len(removed)} removed and {len(modified)} modified documents")
+        if modified:
+            self._text_extractor.extract_text_from_pdfs(
+                modified, allow_ocr, progress=progress, force=True
+            )
+        if folder_path:
+            self._text_extractor.extract_text_from_pdfs(
+                folder_path, allow_ocr, progress=progress
+            )
+        # new, modified and extracted again documents are pending
+        removed_paths = {d["pdf_path"] for d in removed}
+        documents = [
+            d
+            for d in self._catalog.pending()
+            if d["pdf_path"] not in removed_paths
+        ]
+        writer = None
+        try:
+            writer = self._open_writer(procs=os.cpu_count())
+            locations = []
+            for document in removed:
+                writer.delete_by_term("path", document["pdf_path"])
+                locations.append(self._documents.removal(document["pdf_path"]))
+            locations += self._add_to_writer(
+                writer, documents, progress, update=True
+            )
+            self._commit(
+                writer, [d["pdf_path"] for d in documents], progress, locations
+            )
+            self._catalog.remove(d["pdf_path"] for d in removed)
+            self._remove_unused_texts(removed)
+            self._documents.compact(DOCUMENT_STORE_MAX_WASTE)
+            return True
+        except Exception as e:
+            print(colored(e, "red"))
+            # cancel documents indexation, only if this call opened the writer
+            if writer is not None and not writer.is_closed:
+                writer.cancel()
+            return False
+
+    def retag_documents(self, batch_size=500, progress=None):
+        """
+        Recomputes tags and categories of documents tagged with a previous
+        vocabulary, in parallel and committing in batches, so an interrupted
+        run resumes where it stopped. Only documents containing keywords or
+        carrying tags the new vocabulary changes are tagged again.
+
+        :param batch_size: number of documents committed at a time
+        :param progress: receives the number of documents processed by each stage
+        :return: if tagging process was successful
+        """
+        progress = progress or Progress()
+        outdated = [
+            dict(d)
+            for d in self._catalog.outdated_vocabulary(self._vocabulary)
+        ]
+        batch = []
+        locations = []
+        writer = None
+        try:
+            documents, unchanged = self._get_affected_documents(outdated)
+            # the other documents are tagged the same by both vocabularies
+            self._catalog.add_vocabulary(
+                self._vocabulary,
+                {"keywords": self._keywords, "tags": self._tags},
+            )
+            self._catalog.mark_indexed(
+                [d["pdf_path"] for d in unchanged], vocabulary=self._vocabulary
+            )
+            print(f"Tagging {len(documents)} documents with new vocabulary")
+            progress.start("tagged", len(documents))
+            progress.start("indexed", len(documents))
+            with Pool(
+                os.cpu_count(),
+                initializer=_init_tagging_worker,
+                initargs=(self,),
+            ) as pool:
+                for document, content, tags, categories in metrics.merged(
+                    pool.imap_unordered(_tag_document, documents, chunksize=8)
+                ):
+                    progress.advance("tagged")
+                    if writer is None:
+                        writer = self._open_writer()
+                    # whoosh replaces whole documents, content is read again
+                    # from the extracted text
+                    location = self._add_document(
+                        writer, document, content, tags, categories, True
+                    )
+                    progress.advance("indexed")
+                    batch.append(document["pdf_path"])
+                    locations.append(location)
+                    if len(batch) == batch_size:
+                        self._commit(writer, batch, progress, locations)
+                        # a committed writer is closed, the next batch opens
+                        # another one
+                        writer = None
+                        batch = []
+                        locations = []
+            if writer is not None:
+                self._commit(writer, batch, progress, locations)
+            self._documents.compact(DOCUMENT_STORE_MAX_WASTE)
+            return True
+        except Exception as e:
+            print(colored(e, "red"))
+            # cancel tagging of the current batch
+            if writer is not None and not writer.is_closed:
+                writer.cancel()
+            return False
+
+    def _get_affected_documents(self, documents):
+        """
+        Separates documents whose tags may change from the vocabulary they
+        were tagged with to the current one from the documents tagged the
+        same by both.
+
+        :param documents: catalog rows of documents tagged with a previous vocabulary
+        :return: tuple with the list of documents affected and the list of documents unchanged
+        """
+        by_vocabulary = defaultdict(list)
+        for document in documents:
+            by_vocabulary[document["vocabulary"]].append(document)
+        affected, unchanged = [], []
+        for fingerprint, group in by_vocabulary.items():
+            previous = fingerprint and self._catalog.get_vocabulary(
+                fingerprint
+            )
+            changes = previous and self._get_vocabulary_changes(previous)
+            if not changes:
+                # tagged with an unknown vocabulary or keywords reordered
+                affected.extend(group)
+                continue
+            keywords, tags = changes
+            tagged = self._get_tagged_paths(tags)
+            matcher = KeywordMatcher(keywords)
+            for document in group:
+                if document["pdf_path"] in tagged or self._has_keywords(
+                    matcher, document
+                ):
+                    affected.append(document)
+                else:
+                    unchanged.append(document)
+        return affected, unchanged
+
+    def _get_vocabulary_changes(self, previous):
+        """
+        Compares a previous vocabulary with the current one.
+
+        :param previous: dictionary with the keywords and tags of the previous vocabulary
+        :return: tuple with the keywords whose tags changed and the tags whose category changed, or None if keywords were reordered
+        """
+        before = self._get_tags_by_keyword(previous["keywords"])
+        after = self._get_tags_by_keyword(self._keywords)
+        # tags and categories of a document follow the keywords order
+        if [kw for kw in before if kw in after] != [
+            kw for kw in after if kw in before
+        ]:
+            return None
+        keywords = [
+            kw
+            for kw in chain(before, after)
+            if before.get(kw) != after.get(kw)
+        ]
+        tags = [
+            t
+            for t in set(previous["tags"]) | set(self._tags)
+            if previous["tags"].get(t) != self._tags.get(t)
+        ]
+        return keywords, tags
+
+    def _get_tags_by_keyword(self, keywords):
+        """
+        Gets the tags of each keyword of a vocabulary.
+
+        :param keywords: keywords of each tag
+        :return: dictionary with the tags of each keyword, in the vocabulary order
+        """
+        tags = {}
+        for tag, kws in keywords.items():
+            for kw in kws:
+                tags.setdefault(kw, []).append(tag)
+        return tags
+
+    def _get_tagged_paths(self, tags):
+        """
+        Gets the documents indexed with any of the tags.
+
+        :param tags: tags searched
+        :return: set of paths to the original pdf files of the documents
+        """
+        paths = set()
+        if not tags:
+            return paths
+        query = Or([Term("tags", t.lower()) for t in tags])
+        for shard in self._shards:
+            with shard.searcher() as searcher:
+                for hit in searcher.search(query, limit=None):
+                    paths.add(hit["path"])
+        return paths
+
+    def _has_keywords(self, matcher, document):
+        """
+        Checks if a document contains any keyword, the way it's tagged.
+
+        :param matcher: matcher of the keywords
+        :param document: catalog row of the document
+        :return: whether any keyword is found in the extracted text
+        """
+        if not matcher.keywords:
+            return False
+        with open(document["txt_path"], "r") as fp:
+            content = self._process_content(fp.read())
+        return any(True for _ in self._iter_valid_matches(matcher, content))
+
+    def _remove_unused_texts(self, documents):
+        """
+        Deletes files containing text of documents no longer registered.
+
+        :param documents: catalog rows of documents removed
+        """
+        in_use = {d["txt_path"] for d in self._catalog.documents()}
+        for document in documents:
+            txt_path = document["txt_path"]
+            if txt_path not in in_use and os.path.exists(txt_path):
+                os.remove(txt_path)
+
+    def _commit(self, writer, pdf_paths, progress, locations=()):
+        """
+        Commits documents added to the writer and registers them as indexed.
+
+        :param writer: writer of the index
+        :param pdf_paths: paths to the original pdf files of the documents
+        :param progress: receives the number of documents committed
+        :param locations: locations of the content written to the document store for the documents, or of its removal, None if the content is stored in the index
+        """
+        print("Committing indexes")
+        progress.start("committed", len(pdf_paths))
+        # commits new documents
+        with metrics.WRITER_SECONDS.time(operation="commit"):
+            writer.commit()
+        # the document store only changes along with the index
+        self._documents.register([loc for loc in locations if loc is not None])
+        progress.advance("committed", len(pdf_paths))
+        # makes pooled searchers pick up the new generation
+        for shard in self._shards:
+            shard.refresh()
+        self._cache.clear()
+        # register new indexed documents and the vocabulary they were tagged
+        # with, kept to find the documents a later vocabulary changes
+        self._catalog.add_vocabulary(
+            self._vocabulary, {"keywords": self._keywords, "tags": self._tags}
+        )
+        self._catalog.mark_indexed(pdf_paths, vocabulary=self._vocabulary)
+
+    def search_documents(
+        self,
+        query_str,
+        terms=True,
+        advanced=False,
+        page=None,
+        page_size=20,
+        snippets=False,
+        filter_tags=None,
+        facets=False,
+        fuzzy=False,
+    ):
         """
         Search for documents respecting query restrictions.
 
         :param query_str: query arguments in format {'AND': [...], 'OR': [...], 'NOT': [...], 'TAG': [...] }
         :param terms: whether to perform a search by terms within the documents
         :param advanced: whether to perform an advanced search in the documents
+        :param page: page of results following the index ranking, all results are returned if not given
+        :param page_size: number of results per page
+        :param snippets: whether to include passages of the content around matches
+        :param filter_tags: only documents with every one of these tags are found
+        :param facets: whether to include the number of documents found with each tag and category
+        :param fuzzy: whether to also match close variants of the terms, e.g. misspelled by OCR
         :return: documents found respecting query restrictions
         """
+        start = time.perf_counter()
+        search_type = self._get_search_type(terms, advanced)
         query_json = json.loads(query_str)
-        query_str_list = self._get_query_list(query_json, terms, advanced)
-        query_str = self._get_query_str(query_str_list, terms, advanced)
-        # opens register of indexed documents
-        ix = open_dir(f"{self._index_folder}")
-        # choose score function depending on type of search
-        scorer = Frequency()
-        with ix.searcher(weighting=scorer) as searcher:
+        cache_key = self._get_cache_key(
+            query_json,
+            terms,
+            advanced,
+            page,
+            page_size,
+            snippets,
+            filter_tags,
+            facets,
+            fuzzy,
+        )
+        generation = tuple(shard.generation() for shard in self._shards)
+        cached = self._cache.get(cache_key, generation)
+        metrics.QUERIES.inc(
+            type=search_type, cache="miss" if cached is None else "hit"
+        )
+        if cached is not None:
+            return cached
+        with self._search(
+            query_json,
+            terms,
+            advanced,
+            page,
+            page_size,
+            snippets,
+            filter_tags,
+            facets,
+            fuzzy,
+        ) as (total, hits, facet_counts):
+            data = self._get_response(hits, total, terms, page, page_size)
+        if facets:
+            data["facets"] = facet_counts
+        with metrics.QUERY_PHASE_SECONDS.time(phase="serialization"):
+            result = json.dumps(data, ensure_ascii=False)
+        self._cache.put(cache_key, generation, result)
+        self._record_query(
+            query_json, search_type, page, time.perf_counter() - start
+        )
+        return result
+
+    def search_documents_batch(self, queries_str, page=None, page_size=20):
+        """
+        Search for documents respecting the restrictions of many queries at
+        once, on the same searchers and counting the occurrences of the terms
+        of every query in each document found at the same time.
+
+        :param queries_str: list of query arguments in format {'AND': [...], 'OR': [...], 'NOT': [...], 'TAG': [...] }, a query is a search for tags if it has 'TAG', an advanced search if it has 'OR' or 'NOT', and a search for terms otherwise
+        :param page: page of results of each query following the index ranking, all results are returned if not given
+        :param page_size: number of results per page
+        :return: documents found by each query, in the same order
+        """
+        start = time.perf_counter()
+        queries = []
+        for query_json in json.loads(queries_str):
+            terms = "TAG" not in query_json
+            advanced = terms and ("OR" in query_json or "NOT" in query_json)
+            if advanced:
+                # restrictions left out of advanced searches are empty
+                query_json = {"AND": [], "OR": [], "NOT": [], **query_json}
+            queries.append((query_json, terms, advanced))
+        # queries already answered are taken from the cache, as if they were
+        # searched one by one
+        generation = tuple(shard.generation() for shard in self._shards)
+        cache_keys = []
+        results = []
+        pending = []
+        for i, (query_json, terms, advanced) in enumerate(queries):
+            cache_key = self._get_cache_key(
+                query_json, terms, advanced, page, page_size
+            )
+            cached = self._cache.get(cache_key, generation)
+            metrics.QUERIES.inc(
+                type=self._get_search_type(terms, advanced),
+                cache="miss" if cached is None else "hit",
+            )
+            cache_keys.append(cache_key)
+            results.append(cached)
+            if cached is None:
+                pending.append(i)
+        if pending:
+            searched = self._search_batch(
+                [queries[i] for i in pending], page, page_size
+            )
+            for i, data in zip(pending, searched):
+                with metrics.QUERY_PHASE_SECONDS.time(phase="serialization"):
+                    results[i] = json.dumps(data, ensure_ascii=False)
+                self._cache.put(cache_keys[i], generation, results[i])
+        self._record_query(
+            [q for q, _, _ in queries],
+            "batch",
+            page,
+            time.perf_counter() - start,
+        )
+        return '{"results": [' + ", ".join(results) + "]}"
+
+    def iter_search_documents(
+        self,
+        query_str,
+        terms=True,
+        advanced=False,
+        page=None,
+        page_size=20,
+        snippets=False,
+        filter_tags=None,
+        fuzzy=False,
+    ):
+        """
+        Search for documents respecting query restrictions, yielding each
+        document as soon as it's scored, following the index ranking.
+
+        :param query_str: query arguments in format {'AND': [...], 'OR': [...], 'NOT': [...], 'TAG': [...] }
+        :param terms: whether to perform a search by terms within the documents
+        :param advanced: whether to perform an advanced search in the documents
+        :param page: page of results following the index ranking, all results are returned if not given
+        :param page_size: number of results per page
+        :param snippets: whether to include passages of the content around matches
+        :param filter_tags: only documents with every one of these tags are found
+        :param fuzzy: whether to also match close variants of the terms, e.g. misspelled by OCR
+        :return: generator of documents found respecting query restrictions
+        """
+        start = time.perf_counter()
+        search_type = self._get_search_type(terms, advanced)
+        query_json = json.loads(query_str)
+        metrics.QUERIES.inc(type=search_type, cache="bypass")
+        with self._search(
+            query_json,
+            terms,
+            advanced,
+            page,
+            page_size,
+            snippets,
+            filter_tags,
+            fuzzy=fuzzy,
+        ) as (_, hits, _):
+            yield from hits
+        # includes the time the consumer took to receive the results
+        self._record_query(
+            query_json, search_type, page, time.perf_counter() - start
+        )
+
+    def cache_stats(self):
+        """
+        Gets usage statistics of the search results cache.
+
+        :return: dictionary with hits, misses, evictions and size of the cache
+        """
+        return self._cache.stats()
+
+    def warm_up(self, queries=()):
+        """
+        Opens the searchers of every shard, reads the documents of each tag
+        and category and runs searches, so the first requests don't pay for
+        it.
+
+        :param queries: list of query arguments, typed as in a batch search
+        """
+        for shard, pool in enumerate(self._shards):
+            with pool.searcher() as searcher:
+                self._get_tag_documents(shard, searcher)
+        if queries:
+            self.search_documents_batch(json.dumps(queries))
+
+    def after_fork(self):
+        """
+        Prepares an indexer inherited from a parent process. Searchers and
+        threads aren't shared with the parent, so they are opened again on
+        first use, while the vocabulary and the caches built before the fork
+        are kept.
+        """
+        for pool in self._shards:
+            pool.reset()
+        if self._executor is not None:
+            self._executor = ThreadPoolExecutor(len(self._shards))
+
+    def extraction_report(self):
+        """
+        Gets the report of the last text extraction.
+
+        :return: dictionary with the files that failed, timed out or crashed, or None if there was no extraction
+        """
+        return self._text_extractor.report()
+
+    def _get_cache_key(
+        self,
+        query_json,
+        terms,
+        advanced,
+        page,
+        page_size,
+        snippets=False,
+        filter_tags=None,
+        facets=False,
+        fuzzy=False,
+    ):
+        """
+        Gets the key of the cached result of a search. Results are cached by
+        query and type of search, while the index generation stays the same.
+
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :param snippets: whether to include passages of the content around matches
+        :param filter_tags: only documents with every one of these tags are found
+        :param facets: whether to count the documents found with each tag and category
+        :param fuzzy: whether close variants of the terms are matched
+        :return: cache key
+        """
+        return (
+            json.dumps(query_json, sort_keys=True, ensure_ascii=False),
+            terms,
+            advanced,
+            page,
+            page_size,
+            snippets,
+            tuple(sorted(filter_tags or [])),
+            facets,
+            fuzzy,
+        )
+
+    def _get_response(self, hits, total, terms, page, page_size):
+        """
+        Gets the response of a search.
+
+        :param hits: documents found
+        :param total: total number of matches
+        :param terms: whether is a search for terms
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :return: dictionary with the documents found, and the page if any
+        """
+        data = {"results": list(hits)}
+        if page is None:
+            if terms:
+                data["results"].sort(key=lambda x: x["score"], reverse=True)
+        else:
+            data.update({"page": page, "page_size": page_size, "total": total})
+        return data
+
+    def get_document_content(self, path):
+        """
+        Gets the processed content of an indexed document.
+
+        :param path: path to the original pdf file of the document
+        :return: document content, or None if the document isn't indexed
+        """
+        shard = self._shards[shard_of(path, len(self._shards))]
+        with shard.searcher() as searcher:
+            if searcher.schema["content"].stored:
+                fields = searcher.document(path=path)
+                return fields["content"] if fields else None
+        return self._documents.get(path)
+
+    def get_matching_pages(self, path, query_str_list):
+        """
+        Gets the pages of an indexed document containing any of the terms,
+        using the page boundaries kept in its content.
+
+        :param path: path to the original pdf file of the document
+        :param query_str_list: list of terms
+        :return: list of page numbers, or None if the document isn't indexed
+        """
+        content = self.get_document_content(path)
+        if content is None:
+            return None
+        patterns = [self._normalize_text(q) for q in query_str_list]
+        patterns = [p for p in patterns if p]
+        return [
+            i + 1
+            for i, page in enumerate(content.split("\f"))
+            if any(p in page for p in patterns)
+        ]
+
+    @contextmanager
+    def _search(
+        self,
+        query_json,
+        terms,
+        advanced,
+        page,
+        page_size,
+        snippets,
+        filter_tags=None,
+        facets=False,
+        fuzzy=False,
+    ):
+        """
+        Runs a search on a pooled searcher.
+
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :param snippets: whether to include passages of the content around matches
+        :param filter_tags: only documents with every one of these tags are found
+        :param facets: whether to count the documents found with each tag and category
+        :param fuzzy: whether to also match close variants of the terms
+        :return: context manager yielding the total number of matches, a generator of documents found and the facet counts, None if not counted
+        """
+        if self._executor is not None:
+            yield self._search_shards(
+                query_json,
+                terms,
+                advanced,
+                page,
+                page_size,
+                snippets,
+                filter_tags,
+                facets,
+                fuzzy,
+            )
+            return
+        # borrows a searcher over the register of indexed documents
+        with self._shards[0].searcher() as searcher:
+            expansions = None
+            if fuzzy:
+                expansions = self._get_expansions(
+                    0, searcher, query_json, terms, advanced
+                )
+            query_str_list, results, total, postings = self._run_query(
+                searcher,
+                query_json,
+                terms,
+                advanced,
+                filter_tags,
+                expansions=expansions,
+            )
+            facet_counts = None
+            if page is not None or facets:
+                valid = self._get_valid_hits(
+                    query_json,
+                    query_str_list,
+                    terms,
+                    advanced,
+                    results,
+                    postings,
+                )
+                if facets:
+                    facet_counts = self._get_facets(0, searcher, valid)
+                results = valid
+                if page is not None:
+                    total = len(valid)
+                    results = valid[(page - 1) * page_size : page * page_size]
+            hits = self._iter_hits(
+                query_json,
+                query_str_list,
+                terms,
+                advanced,
+                results,
+                postings,
+                snippets,
+                expansions,
+            )
+            yield total, hits, facet_counts
+
+    def _search_shards(
+        self,
+        query_json,
+        terms,
+        advanced,
+        page,
+        page_size,
+        snippets,
+        filter_tags,
+        facets,
+        fuzzy,
+    ):
+        """
+        Runs a search on every shard concurrently, merging their results.
+
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :param snippets: whether to include passages of the content around matches
+        :param filter_tags: only documents with every one of these tags are found
+        :param facets: whether to count the documents found with each tag and category
+        :param fuzzy: whether to also match close variants of the terms
+        :return: tuple with the total number of matches, a generator of documents found and the facet counts, None if not counted
+        """
+
+        def search_shard(number):
+            with self._shards[number].searcher() as searcher:
+                # terms are expanded with the vocabulary of each shard
+                expansions = None
+                if fuzzy:
+                    expansions = self._get_expansions(
+                        number, searcher, query_json, terms, advanced
+                    )
+                query_str_list, results, total, postings = self._run_query(
+                    searcher,
+                    query_json,
+                    terms,
+                    advanced,
+                    filter_tags,
+                    expansions=expansions,
+                )
+                facet_counts = None
+                if page is not None or facets:
+                    valid = self._get_valid_hits(
+                        query_json,
+                        query_str_list,
+                        terms,
+                        advanced,
+                        results,
+                        postings,
+                    )
+                    if facets:
+                        facet_counts = self._get_facets(
+                            number, searcher, valid
+                        )
+                    results = valid
+                    if page is not None:
+                        # the top documents of a page may come from any shard
+                        total = len(valid)
+                        results = valid[: page * page_size]
+                start = time.perf_counter()
+                # invalid hits keep their rank, as in a single index
+                hits = [
+                    (
+                        hit.score,
+                        self._score_hit(
+                            query_json,
+                            query_str_list,
+                            terms,
+                            advanced,
+                            hit,
+                            postings,
+                            snippets,
+                            expansions,
+                        ),
+                    )
+                    for hit in results
+                ]
+                metrics.QUERY_PHASE_SECONDS.observe(
+                    time.perf_counter() - start, phase="scoring"
+                )
+                return total, hits, facet_counts
+
+        shard_results = list(
+            self._executor.map(search_shard, range(len(self._shards)))
+        )
+        total, results = self._merge_shard_hits(
+            [(total, hits) for total, hits, _ in shard_results],
+            page,
+            page_size,
+        )
+        facet_counts = None
+        if facets:
+            # shards have disjoint documents, so their counts are summed
+            facet_counts = self._merge_facets([f for _, _, f in shard_results])
+        return total, results, facet_counts
+
+    def _merge_shard_hits(self, shard_hits, page, page_size):
+        """
+        Merges the scored hits of every shard.
+
+        :param shard_hits: tuples with the total number of matches and the scored hits of each shard, with their index score
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :return: tuple with the total number of matches and a generator of documents found
+        """
+        total = sum(shard_total for shard_total, _ in shard_hits)
+        hits = [hit for _, hits in shard_hits for hit in hits]
+        # scores of the index only depend on each document, so they rank
+        # documents of different shards consistently, paged or not
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        if page is not None:
+            hits = hits[(page - 1) * page_size : page * page_size]
+        return total, (result for _, result in hits if result is not None)
+
+    def _search_batch(self, queries, page, page_size):
+        """
+        Runs many searches on every shard, merging their results.
+
+        :param queries: tuples with the query parameters, whether is a search for terms and whether is an advanced search
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :return: list with the response of each search
+        """
+        if self._executor is None:
+            shard_results = [
+                self._search_batch_shard(0, queries, page, page_size)
+            ]
+        else:
+
+            def search_shard(number):
+                # the top documents of a page may come from any shard
+                return self._search_batch_shard(
+                    number,
+                    queries,
+                    None if page is None else 1,
+                    None if page is None else page * page_size,
+                )
+
+            shard_results = list(
+                self._executor.map(search_shard, range(len(self._shards)))
+            )
+        responses = []
+        for i, (_, terms, _) in enumerate(queries):
+            shard_hits = [hits[i] for hits in shard_results]
+            if self._executor is None:
+                total, hits = shard_hits[0]
+                hits = (result for _, result in hits if result is not None)
+            else:
+                total, hits = self._merge_shard_hits(
+                    shard_hits, page, page_size
+                )
+            responses.append(
+                self._get_response(hits, total, terms, page, page_size)
+            )
+        return responses
+
+    def _search_batch_shard(self, shard, queries, page, page_size):
+        """
+        Runs many searches on a shard, counting the occurrences of every term
+        of the searches once for each document found.
+
+        :param shard: number of the shard
+        :param queries: tuples with the query parameters, whether is a search for terms and whether is an advanced search
+        :param page: page of results, all results are returned if None
+        :param page_size: number of results per page
+        :return: list with the total number of matches and the scored hits of each search, with their index score
+        """
+        with self._shards[shard].searcher() as searcher:
+            searches = []
+            for query_json, terms, advanced in queries:
+                query_str_list, results, total, _ = self._run_query(
+                    searcher,
+                    query_json,
+                    terms,
+                    advanced,
+                    count_postings=False,
+                )
+                searches.append((query_str_list, results, total))
+            # terms and documents shared by many searches are counted once
+            query_str_list = list(
+                dict.fromkeys(q for s in searches for q in s[0])
+            )
+            contained = None
+            with metrics.QUERY_PHASE_SECONDS.time(phase="search"):
+                if searcher.schema["content"].stored:
+                    docnums = {h.docnum for s in searches for h in s[1]}
+                    postings, contained = self._get_batch_occurrences(
+                        searcher, query_str_list, docnums
+                    )
+                else:
+                    postings = self._get_postings_occurrences(
+                        searcher, query_str_list
+                    )
+            start = time.perf_counter()
+            shard_hits = []
+            for (query_json, terms, advanced), search in zip(
+                queries, searches
+            ):
+                query_str_list, results, total = search
+                if page is not None:
+                    valid = self._get_valid_hits(
+                        query_json,
+                        query_str_list,
+                        terms,
+                        advanced,
+                        results,
+                        postings,
+                        contained,
+                    )
+                    total = len(valid)
+                    results = valid[(page - 1) * page_size : page * page_size]
+                # invalid hits keep their rank, as in a single search
+                hits = [
+                    (
+                        hit.score,
+                        self._score_hit(
+                            query_json,
+                            query_str_list,
+                            terms,
+                            advanced,
+                            hit,
+                            postings,
+                            False,
+                            contained=contained,
+                        ),
+                    )
+                    for hit in results
+                ]
+                shard_hits.append((total, hits))
+            metrics.QUERY_PHASE_SECONDS.observe(
+                time.perf_counter() - start, phase="scoring"
+            )
+            return shard_hits
+
+    def _get_batch_occurrences(self, searcher, query_str_list, docnums):
+        """
+        Counts matches of many terms in the content of documents, reading the
+        content of each document once.
+
+        :param searcher: searcher of the index or of a shard
+        :param query_str_list: list of terms to count
+        :param docnums: numbers of the documents
+        :return: tuple with the number of matches of each term by document number, and the numbers of the documents containing each term
+        """
+        patterns = {q: self._normalize_text(q) for q in query_str_list}
+        unique_patterns = list(dict.fromkeys(patterns.values()))
+        # a scan with every term only pays off over many scans with few terms
+        matcher = None
+        if len(unique_patterns) >= BATCH_MATCHER_MIN_TERMS:
+            matcher = KeywordMatcher(unique_patterns)
+        occurrences = {q: {} for q in query_str_list}
+        contained = {q: set() for q in query_str_list}
+        for docnum in sorted(docnums):
+            content = searcher.stored_fields(docnum)["content"]
+            if matcher is not None:
+                counts = matcher.count(content)
+            else:
+                counts = {
+                    p: sum(1 for _ in re.finditer(p, content))
+                    for p in unique_patterns
+                }
+            for q, p in patterns.items():
+                occurrences[q][docnum] = counts.get(p, 0)
+                # terms are valid as substrings, even if their count as a
+                # pattern differs
+                if p in content:
+                    contained[q].add(docnum)
+        return occurrences, contained
+
+    def _run_query(
+        self,
+        searcher,
+        query_json,
+        terms,
+        advanced,
+        filter_tags=None,
+        count_postings=True,
+        expansions=None,
+    ):
+        """
+        Parses and runs a search on a searcher, ranking every match, as pages
+        are only known after matches are checked, see _get_valid_hits.
+
+        :param searcher: searcher of the index or of a shard
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param filter_tags: only documents with every one of these tags are found
+        :param count_postings: whether to count matches from postings when the content isn't stored
+        :param expansions: variants of each word of each term in a fuzzy search, None in an exact search
+        :return: tuple with the list of terms to count, hits of the search, total number of matches and number of matches of each term by document number, or None if counted from the content
+        """
+        with metrics.QUERY_PHASE_SECONDS.time(phase="parse"):
+            query_str_list = self._get_query_list(query_json, terms, advanced)
             # choose where to search depending on type of search
-            query = QueryParser(
-                "content" if terms else "tags", ix.schema
-            ).parse(query_str)
-            data = {"results": []}
-            results = searcher.search(query, limit=None)
+            query = self._get_query(
+                query_json,
+                query_str_list,
+                terms,
+                advanced,
+                searcher.schema,
+                expansions,
+            )
+            # drills down into documents with the given tags, the filter is
+            # cached by the searcher
+            tags_filter = None
+            if filter_tags:
+                tags_filter = And(
+                    [Term("tags", t.lower()) for t in filter_tags]
+                )
+        with metrics.QUERY_PHASE_SECONDS.time(phase="search"):
+            results = searcher.search(query, limit=None, filter=tags_filter)
+            total = len(results)
+            postings = None
+            # without stored content, or with variants the content can't be
+            # scanned for, matches are counted from postings
+            if expansions is not None or (
+                count_postings and not searcher.schema["content"].stored
+            ):
+                postings = self._get_postings_occurrences(
+                    searcher, query_str_list, expansions
+                )
+        return query_str_list, results, total, postings
+
+    def _iter_hits(
+        self,
+        query_json,
+        query_str_list,
+        terms,
+        advanced,
+        results,
+        postings,
+        snippets,
+        expansions=None,
+    ):
+        """
+        Scores the valid hits of a search.
+
+        :param query_json: dictionary with query parameters
+        :param query_str_list: list of terms to count
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param results: hits of the search
+        :param postings: number of matches of each term by document number, counted from the content if None
+        :param snippets: whether to include passages of the content around matches
+        :param expansions: variants of each word of each term in a fuzzy search
+        :return: generator of documents found
+        """
+        elapsed = 0
+        try:
             for hit in results:
+                start = time.perf_counter()
+                result = self._score_hit(
+                    query_json,
+                    query_str_list,
+                    terms,
+                    advanced,
+                    hit,
+                    postings,
+                    snippets,
+                    expansions,
+                )
+                elapsed += time.perf_counter() - start
+                if result is not None:
+                    yield result
+        finally:
+            metrics.QUERY_PHASE_SECONDS.observe(elapsed, phase="scoring")
+
+    def _score_hit(
+        self,
+        query_json,
+        query_str_list,
+        terms,
+        advanced,
+        hit,
+        postings,
+        snippets,
+        expansions=None,
+        contained=None,
+    ):
+        """
+        Scores a hit of a search.
+
+        :param query_json: dictionary with query parameters
+        :param query_str_list: list of terms to count
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param hit: hit of the search
+        :param postings: number of matches of each term by document number, counted from the content if None
+        :param snippets: whether to include passages of the content around matches
+        :param expansions: variants of each word of each term in a fuzzy search
+        :param contained: numbers of the documents whose content contains each term, checked instead of the number of matches if given
+        :return: document found, or None if the hit isn't valid
+        """
+        if not self._is_valid_hit(
+            query_json,
+            query_str_list,
+            terms,
+            advanced,
+            hit,
+            postings,
+            contained,
+        ):
+            return None
+        content = None
+        if postings is None:
+            content = hit["content"]
+            occurrences = self._get_content_occurrences(
+                query_str_list, content
+            )
+        else:
+            occurrences = {
+                q: postings[q].get(hit.docnum, 0) for q in query_str_list
+            }
+        # score is the number of matches of every term
+        score = sum(occurrences[q] for q in query_str_list)
+        occurrences = json.dumps(occurrences, ensure_ascii=False)
+        result = {
+            "title": hit["title"],
+            "path": hit["path"],
+            "occurrences": occurrences,
+            "categories": hit["categories"],
+            "score": score,
+        }
+        if snippets:
+            # content outside the index is only read when needed
+            if content is None and hit.searcher.schema["content"].stored:
                 content = hit["content"]
-                if not self._get_hit_validity(
-                    query_json, terms, advanced, content
-                ):
-                    continue
-                occurrences = {}
-                score = 0
-                # calculates number of matches for each term
-                for q in query_str_list:
-                    positions = [
-                        (t.start(), t.end())
-                        for t in re.finditer(self._normalize_text(q), content)
-                    ]
-                    occurrences[q] = len(positions)
-                    score += len(positions)
-                occurrences = json.dumps(occurrences, ensure_ascii=False)
-                data["results"].append(
-                    {
-                        "title": hit["title"],
-                        "path": hit["path"],
-                        "occurrences": occurrences,
-                        "categories": hit["categories"],
-                        "score": score,
-                    }
+            elif content is None:
+                content = self._documents.get(hit["path"]) or ""
+            result["snippets"] = self._get_snippets(
+                query_str_list, content, expansions
+            )
+        return result
+
+    def _is_valid_hit(
+        self,
+        query_json,
+        query_str_list,
+        terms,
+        advanced,
+        hit,
+        postings,
+        contained=None,
+    ):
+        """
+        Checks if a hit of a search respects the query restrictions.
+
+        :param query_json: dictionary with query parameters
+        :param query_str_list: list of terms to count
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param hit: hit of the search
+        :param postings: number of matches of each term by document number, the content is checked if None
+        :param contained: numbers of the documents whose content contains each term, checked instead of the number of matches if given
+        :return: whether the hit is valid
+        """
+        if postings is None:
+            return self._get_hit_validity(
+                query_json, terms, advanced, hit["content"]
+            )
+        if contained is not None:
+            return self._get_contained_validity(
+                query_json, terms, advanced, hit.docnum, contained
+            )
+        occurrences = {
+            q: postings[q].get(hit.docnum, 0) for q in query_str_list
+        }
+        return self._get_occurrences_validity(
+            query_json, terms, advanced, occurrences
+        )
+
+    def _get_valid_hits(
+        self,
+        query_json,
+        query_str_list,
+        terms,
+        advanced,
+        results,
+        postings,
+        contained=None,
+    ):
+        """
+        Gets the hits of a search respecting the query restrictions, following
+        the index ranking, so pages are sliced from them and the total and
+        facets only count valid hits.
+
+        :param query_json: dictionary with query parameters
+        :param query_str_list: list of terms to count
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param results: hits of the search
+        :param postings: number of matches of each term by document number, the content is checked if None
+        :param contained: numbers of the documents whose content contains each term, checked instead of the number of matches if given
+        :return: list of valid hits
+        """
+        with metrics.QUERY_PHASE_SECONDS.time(phase="validation"):
+            valid = [
+                hit
+                for hit in results
+                if self._is_valid_hit(
+                    query_json,
+                    query_str_list,
+                    terms,
+                    advanced,
+                    hit,
+                    postings,
+                    contained,
                 )
-        ix.close()
-        if terms:
-            data["results"].sort(key=lambda x: x["score"], reverse=True)
-        return json.dumps(data, ensure_ascii=False)
+            ]
+        return valid
+
+    def _record_query(self, query_json, search_type, page, seconds):
+        """
+        Records the duration of a search, logging it if it's slow.
+
+        :param query_json: dictionary with query parameters
+        :param search_type: type of search, term, tag or advanced
+        :param page: page of results, None if all results were returned
+        :param seconds: duration of the search
+        """
+        metrics.QUERY_SECONDS.observe(seconds, type=search_type)
+        if (
+            self._slow_query_seconds is None
+            or seconds < self._slow_query_seconds
+        ):
+            return
+        metrics.SLOW_QUERIES.inc(type=search_type)
+        entry = {
+            "time": time.time(),
+            "type": search_type,
+            "query": query_json,
+            "page": page,
+            "seconds": seconds,
+        }
+        entry = json.dumps(entry, ensure_ascii=False)
+        if self._slow_query_log is None:
+            print(colored(f"Slow query: {entry}", "yellow"))
+            return
+        with self._slow_query_lock:
+            with open(self._slow_query_log, "a") as f:
+                print(entry, file=f)
+
+    def _get_shard_folders(self, count):
+        """
+        Gets the folders of the index shards.
 
-    def _add_to_writer(self, paths):
+        :param count: number of shards
+        :return: list of folder paths
+        """
+        if count == 1:
+            return [self._index_folder]
+        return [f"{self._index_folder}/shard-{i}" for i in range(count)]
+
+    def _open_writer(self, procs=1):
+        """
+        Opens a writer routing documents to their shards.
+
+        :param procs: number of processes used by the writers of all shards
+        :return: writer of the index, or of every shard if there are many
+        """
+        procs = max(procs // len(self._shards), 1)
+        writers = []
+        try:
+            for shard in self._shards:
+                writers.append(shard.index.writer(procs=procs, limitmb=256))
+        except Exception:
+            # releases the shards already locked
+            for writer in writers:
+                writer.cancel()
+            raise
+        return writers[0] if len(writers) == 1 else ShardedWriter(writers)
+
+    def _add_to_writer(self, writer, documents, progress, update=False):
         """
         Adds documents to be indexed to the writer.
 
-        :param paths: paths of documents to be indexed
+        :param writer: writer of the index
+        :param documents: catalog rows of documents to be indexed
+        :param progress: receives the number of documents tagged and indexed
+        :param update: whether to replace documents already in the index
+        :return: list of locations of the content of the documents, see _add_document
         """
-        data = pd.read_csv(
-            f"{self._index_folder}/indexed_files.csv", index_col="name"
-        )
-        for path in paths:
-            with open(path, "r") as fp:
-                print(f"Indexing {path}")
-                content = fp.read()
-                content = self._process_content(content)
-                # gets document name from path
-                file_name = path.split("/")[-1][:-4]
-                # gets document original pdf file path
-                file_path = data.loc[file_name, "pdf_path"]
-                tags, categories = self._get_file_tags_categories(content)
-                self._writer.add_document(
-                    title=file_name,
-                    path=file_path,
-                    content=content,
-                    tags=tags,
-                    categories=categories,
+        progress.start("tagged", len(documents))
+        progress.start("indexed", len(documents))
+        locations = []
+        for document in documents:
+            _, content, tags, categories = self._tag_document(document)
+            progress.advance("tagged")
+            locations.append(
+                self._add_document(
+                    writer, document, content, tags, categories, update
                 )
+            )
+            progress.advance("indexed")
+        return locations
+
+    def _tag_document(self, document):
+        """
+        Reads and tags a document to be indexed.
+
+        :param document: catalog row of the document
+        :return: document with its processed content, tags and categories
+        """
+        with metrics.TAGGING_SECONDS.time():
+            with open(document["txt_path"], "r") as fp:
+                print(f"Indexing {document['txt_path']}")
+                content = fp.read()
+            content = self._process_content(content)
+            tags, categories = self._get_file_tags_categories(content)
+        return document, content, tags, categories
+
+    def _add_document(
+        self, writer, document, content, tags, categories, update=False
+    ):
+        """
+        Adds a tagged document to the writer.
+
+        :param writer: writer of the index
+        :param document: catalog row of the document
+        :param content: processed document content
+        :param tags: document tags
+        :param categories: document categories
+        :param update: whether to replace the document if it's in the index, using its unique path
+        :return: location of the content written to the document store, registered once the writer is committed, or None if the content is stored in the index
+        """
+        location = None
+        if not writer.schema["content"].stored:
+            # content is kept compressed outside the index
+            location = self._documents.append(document["pdf_path"], content)
+        add = writer.update_document if update else writer.add_document
+        with metrics.WRITER_SECONDS.time(operation="add"):
+            add(
+                title=document["name"],
+                path=document["pdf_path"],
+                content=content,
+                tags=tags,
+                categories=categories,
+            )
+        return location
 
     def _normalize_text(self, text):
         """
@@ -214,20 +1693,15 @@ class Indexer:
         :param content: document text
         :return: document tags and categories
         """
-        # escape characters to help identifying keywords more precisely
-        esc = "[](){}.,;:/~'\" "
-        keywords_frequency = {}
-        # for each keyword finds positions of occurrences in the content and check if it's valid using escape characters
-        for kw in self._keywords_array:
-            positions = [
-                (t.start() - 1, t.end()) for t in re.finditer(kw, content)
-            ]
-            valid = 0
-            for s, e in positions:
-                if content[s] in esc and content[e] in esc:
-                    valid += 1
-            if valid:
-                keywords_frequency[kw] = valid
+        valid_frequency = defaultdict(int)
+        # finds occurrences of all keywords in a single pass over the content
+        for kw in self._iter_valid_matches(self._keywords_matcher, content):
+            valid_frequency[kw] += 1
+        # keeps keywords in the same order as the vocabulary
+        keywords_frequency = {
+            kw: valid_frequency[kw]
+            for kw in sorted(valid_frequency, key=self._keywords_order.get)
+        }
         # now for each valid keywords discover it's tag
         tag_occurrences = defaultdict(int)
         tags_frequency = []
@@ -255,6 +1729,20 @@ class Indexer:
             json.dumps(categories_tags, ensure_ascii=False),
         )
 
+    def _iter_valid_matches(self, matcher, content):
+        """
+        Finds occurrences of keywords delimited by escape characters.
+
+        :param matcher: matcher of the keywords
+        :param content: processed document content
+        :return: generator of the keywords found, once for each occurrence
+        """
+        # escape characters to help identifying keywords more precisely
+        esc = "[](){}.,;:/~'\" "
+        for s, e, kw in matcher.iter_matches(content):
+            if content[s - 1] in esc and content[e] in esc:
+                yield kw
+
     def _get_keyword_tags(self, keyword):
         """
         Gets the tags associated with the keyword.
@@ -268,6 +1756,94 @@ class Indexer:
                 tags.append(tag)
         return tags
 
+    def _get_facets(self, shard, searcher, results):
+        """
+        Counts the documents found with each tag and category, intersecting
+        them with the documents of each tag in the index.
+
+        :param shard: number of the shard searched
+        :param searcher: searcher of the shard
+        :param results: valid hits of the search, see _get_valid_hits
+        :return: dictionary with the number of documents by tag and by category
+        """
+        with metrics.QUERY_PHASE_SECONDS.time(phase="facets"):
+            tag_documents, category_documents = self._get_tag_documents(
+                shard, searcher
+            )
+            # every valid document, not only the ones of the page
+            found = {hit.docnum for hit in results}
+            return {
+                "tags": self._count_facet(tag_documents, found),
+                "categories": self._count_facet(category_documents, found),
+            }
+
+    def _get_tag_documents(self, shard, searcher):
+        """
+        Gets the documents of each tag and category in a shard, read from the
+        tags postings once for each generation of the shard.
+
+        :param shard: number of the shard
+        :param searcher: searcher of the shard
+        :return: tuple with the set of documents of each tag and of each category
+        """
+        reader = searcher.reader()
+        generation = reader.generation()
+        cached = self._tag_documents.get(shard)
+        if cached is not None and cached[0] == generation:
+            return cached[1], cached[2]
+        tag_documents = {}
+        for tag in reader.lexicon("tags"):
+            tag = tag.decode("utf-8")
+            postings = reader.postings("tags", tag)
+            tag_documents[tag] = frozenset(postings.all_ids())
+        # a category has the documents of any of its tags
+        category_documents = defaultdict(set)
+        categories = {t.lower(): c for t, c in self._tags.items()}
+        for tag, documents in tag_documents.items():
+            if tag in categories:
+                category_documents[categories[tag]].update(documents)
+        category_documents = {
+            c: frozenset(d) for c, d in category_documents.items()
+        }
+        self._tag_documents[shard] = (
+            generation,
+            tag_documents,
+            category_documents,
+        )
+        return tag_documents, category_documents
+
+    def _count_facet(self, facet_documents, found):
+        """
+        Counts the documents found with each value of a facet.
+
+        :param facet_documents: set of documents of each value
+        :param found: documents found
+        :return: number of documents by value, most frequent first
+        """
+        counts = {}
+        for value, documents in facet_documents.items():
+            count = len(documents.intersection(found))
+            if count:
+                counts[value] = count
+        return dict(sorted(counts.items(), key=lambda c: (-c[1], c[0])))
+
+    def _merge_facets(self, facets):
+        """
+        Sums the facet counts of every shard.
+
+        :param facets: facet counts of each shard
+        :return: facet counts of the whole index
+        """
+        merged = {"tags": defaultdict(int), "categories": defaultdict(int)}
+        for shard_facets in facets:
+            for facet, counts in shard_facets.items():
+                for value, count in counts.items():
+                    merged[facet][value] += count
+        return {
+            facet: dict(sorted(counts.items(), key=lambda c: (-c[1], c[0])))
+            for facet, counts in merged.items()
+        }
+
     def _get_tag_category(self, tag):
         """
         Gets the category of the keyword.
@@ -279,15 +1855,38 @@ class Indexer:
 
     def _get_keywords_array(self):
         """
-        Gets an array of all possible keywords.
+        Gets a list of all possible keywords.
 
-        :return: array of keywords
+        :return: list of keywords
         """
         keywords_list = []
         for v in self._keywords.values():
             for kw in v:
                 keywords_list.append(kw)
-        return np.array(keywords_list)
+        return keywords_list
+
+    def _get_vocabulary_fingerprint(self):
+        """
+        Gets a fingerprint of the keywords and tags vocabulary.
+
+        :return: sha256 hex digest of the vocabulary
+        """
+        vocabulary = json.dumps(
+            {"keywords": self._keywords, "tags": self._tags}, sort_keys=True
+        )
+        return hashlib.sha256(vocabulary.encode("utf-8")).hexdigest()
+
+    def _get_search_type(self, terms, advanced):
+        """
+        Gets the name of a type of search.
+
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :return: term, tag or advanced
+        """
+        if not terms:
+            return "tag"
+        return "advanced" if advanced else "term"
 
     def _get_query_list(self, query_json, terms, advanced):
         """
@@ -314,28 +1913,222 @@ class Indexer:
             query_str_list = query_json["TAG"]
         return query_str_list
 
-    def _get_query_str(self, query_str_list, terms, advanced):
+    def _get_query(
+        self,
+        query_json,
+        query_str_list,
+        terms,
+        advanced,
+        schema,
+        expansions=None,
+    ):
         """
-        Constructs a query string depending on the type of search.
+        Constructs the index query depending on the type of search.
 
-        :param query_str_list: list of terms to construct string
+        In an advanced search 'NOT' words are excluded by the index itself.
+        When matches are counted from postings, 'AND' terms are also required
+        and 'OR' terms optional. When the content is scanned, 'AND' terms are
+        substrings that may be parts of longer words the index can't require,
+        so a document matching any term is a candidate for _get_hit_validity.
+
+        :param query_json: dictionary with query parameters
+        :param query_str_list: list of terms to construct query
+        :param terms: whether is a search for terms
         :param advanced: whether is an advanced search
-        :return: query string
+        :param schema: schema of the index
+        :param expansions: variants of each word of each term in a fuzzy search, None in an exact search
+        :return: query
         """
         if not terms:
-            return query_str_list[0]
-        query_str = [
-            f'"{self._normalize_text(query)}"' for query in query_str_list
-        ]
-        if advanced:
-            query_str = " OR ".join(query_str)
+            return QueryParser("tags", schema).parse(query_str_list[0])
+        parser = QueryParser("content", schema)
+        if not advanced:
+            return self._join_queries(
+                And,
+                [
+                    self._get_term_query(parser, q, expansions)
+                    for q in query_str_list
+                ],
+            )
+        # only single words are excluded by the index, phrases may match
+        # across stopwords or punctuation and are left to _get_hit_validity
+        excluded = []
+        for q in query_json["NOT"]:
+            phrase = self._get_phrase_query(parser, q)
+            word = self._normalize_text(q)
+            if isinstance(phrase, Term) and phrase.text == word:
+                excluded.append(phrase)
+        excluded = self._join_queries(Or, excluded)
+        if schema["content"].stored and expansions is None:
+            query = self._join_queries(
+                Or, [self._get_phrase_query(parser, q) for q in query_str_list]
+            )
         else:
-            query_str = " AND ".join(query_str)
-        return query_str
+            query = self._get_required_query(parser, query_json, expansions)
+        if query is not NullQuery and excluded is not NullQuery:
+            query = AndNot(query, excluded)
+        return query
+
+    def _get_required_query(self, parser, query_json, expansions=None):
+        """
+        Constructs the query of an advanced search requiring 'AND' terms and
+        scoring 'OR' terms.
+
+        :param parser: parser for the content field
+        :param query_json: dictionary with query parameters
+        :param expansions: variants of each word of each term in a fuzzy search, None in an exact search
+        :return: query
+        """
+        required = self._join_queries(
+            And,
+            [
+                self._get_term_query(parser, q, expansions)
+                for q in query_json["AND"]
+            ],
+        )
+        optional = self._join_queries(
+            Or,
+            [
+                self._get_term_query(parser, q, expansions)
+                for q in query_json["OR"]
+            ],
+        )
+        if required is NullQuery:
+            return optional
+        if optional is NullQuery:
+            return required
+        # optional terms only add to the score of required matches
+        return AndMaybe(required, optional)
+
+    def _get_phrase_query(self, parser, query_str):
+        """
+        Constructs the query matching a term or phrase in the content.
+
+        :param parser: parser for the content field
+        :param query_str: term or phrase
+        :return: query
+        """
+        return parser.parse(f'"{self._normalize_text(query_str)}"')
+
+    def _get_term_query(self, parser, query_str, expansions=None):
+        """
+        Constructs the query matching a term or phrase in the content, or
+        any of their variants in a fuzzy search.
+
+        :param parser: parser for the content field
+        :param query_str: term or phrase
+        :param expansions: variants of each word of each term in a fuzzy search, None in an exact search
+        :return: query
+        """
+        if expansions is None:
+            return self._get_phrase_query(parser, query_str)
+        words = []
+        for variants in expansions[query_str]:
+            variants = [Term("content", v) for v in variants]
+            words.append(
+                variants[0] if len(variants) == 1 else SpanOr(variants)
+            )
+        if not words:
+            return NullQuery
+        if len(words) == 1:
+            return words[0]
+        # words of a phrase are consecutive, as stopwords aren't indexed
+        return SpanNear2(words, slop=1, ordered=True)
+
+    def _get_expansions(self, shard, searcher, query_json, terms, advanced):
+        """
+        Expands the words of each term of a fuzzy search to their closest
+        variants in the vocabulary of a shard. Words are expanded within an
+        edit distance growing with their length, up to FUZZY_MAX_VARIANTS
+        variants each and FUZZY_MAX_EXPANSIONS for the whole query, while
+        excluded terms are kept exact.
+
+        :param shard: number of the shard
+        :param searcher: searcher of the shard
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :return: dictionary with the variants of each word of each term, the word first, or None in a search for tags
+        """
+        if not terms:
+            return None
+        with metrics.QUERY_PHASE_SECONDS.time(phase="expansion"):
+            trigram_index = self._get_trigram_index(shard, searcher)
+            analyzer = searcher.schema["content"].analyzer
+            excluded = set(query_json["NOT"]) if advanced else set()
+            remaining = FUZZY_MAX_EXPANSIONS
+            expansions = {}
+            for q in self._get_query_list(query_json, terms, advanced):
+                expansions[q] = []
+                for token in analyzer(self._normalize_text(q)):
+                    variants = [token.text]
+                    distance = self._get_fuzzy_distance(token.text)
+                    if q not in excluded and distance and remaining:
+                        similar = trigram_index.similar(
+                            token.text,
+                            distance,
+                            min(FUZZY_MAX_VARIANTS, remaining),
+                        )
+                        variants.extend(word for _, word in similar)
+                        remaining -= len(similar)
+                    expansions[q].append(variants)
+            return expansions
+
+    def _get_fuzzy_distance(self, word):
+        """
+        Gets the maximum edit distance of the variants of a word, so short
+        words don't match unrelated ones.
+
+        :param word: normalized word
+        :return: edit distance
+        """
+        if len(word) < 4:
+            return 0
+        if len(word) < 8:
+            return 1
+        return 2
+
+    def _get_trigram_index(self, shard, searcher):
+        """
+        Gets the trigram index of the content vocabulary of a shard, read
+        from the lexicon once for each generation of the shard.
+
+        :param shard: number of the shard
+        :param searcher: searcher of the shard
+        :return: trigram index
+        """
+        reader = searcher.reader()
+        generation = reader.generation()
+        cached = self._trigram_indexes.get(shard)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        trigram_index = TrigramIndex(
+            word.decode("utf-8") for word in reader.lexicon("content")
+        )
+        self._trigram_indexes[shard] = (generation, trigram_index)
+        return trigram_index
+
+    def _join_queries(self, operator, queries):
+        """
+        Joins queries with a boolean operator, ignoring empty ones.
+
+        :param operator: boolean query class, And or Or
+        :param queries: list of queries
+        :return: joined query, or NullQuery if there are none
+        """
+        queries = [q for q in queries if q is not NullQuery]
+        if not queries:
+            return NullQuery
+        if len(queries) == 1:
+            return queries[0]
+        return operator(queries)
 
     def _get_hit_validity(self, query_json, terms, advanced, content):
         """
-        Checks if the found document is valid depending on search conditions.
+        Checks if the found document is valid depending on search conditions,
+        with 'AND' and 'NOT' terms as substrings of its content. When the
+        content is scanned the index query of an advanced search only
+        excludes 'NOT' words, so this check applies the other conditions.
 
         :param query_json: dictionary with query parameters
         :param terms: whether is a search for terms
@@ -355,14 +2148,135 @@ class Indexer:
                         return False
         return True
 
-    def _get_all_file_paths(self):
+    def _get_occurrences_validity(
+        self, query_json, terms, advanced, occurrences
+    ):
+        """
+        Checks if the found document is valid depending on search conditions,
+        using the number of matches of each term.
+
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param occurrences: number of matches of each term in the document
+        :return: whether the result if valid
+        """
+        if terms:
+            # checks if every 'AND' term is in the document, terms made only
+            # of stopwords aren't indexed and can't be counted
+            for term in query_json["AND"]:
+                if self._is_indexed(term) and not occurrences[term]:
+                    return False
+            if advanced:
+                # checks if no 'NOT' term is in the document
+                for term in query_json["NOT"]:
+                    if occurrences[term]:
+                        return False
+        return True
+
+    def _get_contained_validity(
+        self, query_json, terms, advanced, docnum, contained
+    ):
+        """
+        Checks if the found document is valid depending on search conditions,
+        with the same substring semantics as _get_hit_validity.
+
+        :param query_json: dictionary with query parameters
+        :param terms: whether is a search for terms
+        :param advanced: whether is an advanced search
+        :param docnum: number of the document
+        :param contained: numbers of the documents whose content contains each term
+        :return: whether the result if valid
+        """
+        if terms:
+            # checks if every 'AND' term is in the document
+            for term in query_json["AND"]:
+                if docnum not in contained[term]:
+                    return False
+            if advanced:
+                # checks if no 'NOT' term is in the document
+                for term in query_json["NOT"]:
+                    if docnum in contained[term]:
+                        return False
+        return True
+
+    def _is_indexed(self, query_str):
         """
-        Gets the paths of all non indexed documents.
+        Checks if a term or phrase has any word kept in the index.
 
-        :return: paths of documents
+        :param query_str: term or phrase
+        :return: whether it has words other than stopwords
         """
-        data = pd.read_csv(
-            f"{self._index_folder}/indexed_files.csv", index_col="name"
+        return any(
+            True for _ in self._analyzer(self._normalize_text(query_str))
         )
-        indexed = list(data[data["indexed"] == 0]["txt_path"].values)
-        return indexed
+
+    def _get_content_occurrences(self, query_str_list, content):
+        """
+        Counts matches of each term by scanning the document content.
+
+        :param query_str_list: list of terms to count
+        :param content: document text
+        :return: number of matches of each term
+        """
+        occurrences = {}
+        for q in query_str_list:
+            occurrences[q] = sum(
+                1 for _ in re.finditer(self._normalize_text(q), content)
+            )
+        return occurrences
+
+    def _get_snippets(
+        self, query_str_list, content, expansions=None, size=80, limit=3
+    ):
+        """
+        Gets passages of the content around the first matches of each term.
+
+        :param query_str_list: list of terms
+        :param content: document text
+        :param expansions: variants of each word of each term in a fuzzy search
+        :param size: number of characters around each match
+        :param limit: maximum number of passages for each term
+        :return: list of passages
+        """
+        snippets = []
+        for q in query_str_list:
+            pattern = self._normalize_text(q)
+            if expansions is not None:
+                # any variant of each word, with stopwords between words
+                pattern = r"\W+(?:\w+\W+){0,2}?".join(
+                    "|".join(re.escape(v) for v in variants).join(
+                        ["\\b(?:", ")\\b"]
+                    )
+                    for variants in expansions[q]
+                )
+            for i, t in enumerate(re.finditer(pattern, content)):
+                if i == limit:
+                    break
+                start = max(t.start() - size, 0)
+                snippets.append(content[start : t.end() + size].strip())
+        return snippets
+
+    def _get_postings_occurrences(
+        self, searcher, query_str_list, expansions=None
+    ):
+        """
+        Counts matches of each term in every document using the positions
+        stored in the index postings, without reading documents content.
+
+        :param searcher: searcher over the index
+        :param query_str_list: list of terms to count
+        :param expansions: variants of each word of each term in a fuzzy search, matches of any variant are counted
+        :return: number of matches of each term, by document number
+        """
+        parser = QueryParser("content", searcher.schema)
+        postings = {}
+        for q in query_str_list:
+            postings[q] = {}
+            query = self._get_term_query(parser, q, expansions)
+            # each span is a match of the term or phrase in the document
+            matcher = query.matcher(searcher)
+            while matcher.is_active():
+                postings[q][matcher.id()] = len(matcher.spans())
+                matcher.next()
+        return postings
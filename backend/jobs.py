@@ -0,0 +1,347 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+# stages of indexing, in the order documents go through them
+STAGES = ["extracted", "tagged", "indexed", "committed"]
+# seconds between writes of the progress of a running job
+SAVE_INTERVAL = 1
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it's asked to stop."""
+
+
+class Progress:
+    """Receives progress of an indexing process, ignoring it by default."""
+
+    def start(self, stage, total):
+        """
+        Registers the number of items a stage will process.
+
+        :param stage: name of the stage
+        :param total: number of items
+        """
+
+    def advance(self, stage, count=1):
+        """
+        Registers items processed by a stage.
+
+        :param stage: name of the stage
+        :param count: number of items processed
+        """
+
+
+class Job(Progress):
+    def __init__(self, name, folder):
+        """
+        Class responsible for tracking the state and progress of a background
+        indexing job.
+
+        The state is written to a file in the jobs folder, read by other
+        processes serving the job, which ask it to stop with a cancel file.
+
+        :param name: name of the operation performed by the job
+        :param folder: path where jobs are registered
+        """
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = "queued"
+        self.error = None
+        self._path, self._cancel_path = _job_paths(folder, self.id)
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._created = time.time()
+        self._finished = None
+        self._saved = 0
+        self._stages = {
+            s: {"done": 0, "total": None, "started": None} for s in STAGES
+        }
+        self._save()
+
+    @property
+    def cancelled(self):
+        """Whether the job was asked to stop, possibly by another process."""
+        if not self._cancelled.is_set() and os.path.exists(self._cancel_path):
+            self._cancelled.set()
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Asks the job to stop at the next progress report."""
+        self._cancelled.set()
+
+    def start(self, stage, total):
+        self._check_cancelled()
+        with self._lock:
+            self._stages[stage]["total"] = total
+            # totals of a pipelined indexation are updated once known
+            if self._stages[stage]["started"] is None:
+                self._stages[stage]["started"] = time.time()
+        self._save()
+
+    def advance(self, stage, count=1):
+        self._check_cancelled()
+        with self._lock:
+            if self._stages[stage]["started"] is None:
+                self._stages[stage]["started"] = time.time()
+            self._stages[stage]["done"] += count
+        if time.time() - self._saved >= SAVE_INTERVAL:
+            self._save()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Runs the job operation, recording its outcome.
+
+        :param func: operation returning whether it was successful
+        :param args: arguments of the operation
+        :param kwargs: keyword arguments of the operation
+        """
+        self.status = "running"
+        self._save()
+        try:
+            success = func(*args, progress=self, **kwargs)
+            if self.cancelled:
+                self.status = "cancelled"
+            else:
+                self.status = "done" if success else "failed"
+        except JobCancelled:
+            self.status = "cancelled"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        self._finished = time.time()
+        self._save()
+        if os.path.exists(self._cancel_path):
+            os.remove(self._cancel_path)
+
+    def to_dict(self):
+        """
+        Gets the state of the job with throughput and estimated time to
+        finish each stage.
+
+        :return: dictionary with the job state
+        """
+        now = self._finished or time.time()
+        stages = {}
+        with self._lock:
+            for name, stage in self._stages.items():
+                elapsed = now - stage["started"] if stage["started"] else 0
+                throughput = stage["done"] / elapsed if elapsed else None
+                eta = None
+                if throughput and stage["total"] is not None:
+                    eta = max(stage["total"] - stage["done"], 0) / throughput
+                stages[name] = {
+                    "done": stage["done"],
+                    "total": stage["total"],
+                    "throughput": throughput,
+                    "eta": eta,
+                }
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "error": self.error,
+            "elapsed": now - self._created,
+            "stages": stages,
+        }
+
+    def _check_cancelled(self):
+        """Interrupts the job operation if it was asked to stop."""
+        if self.cancelled:
+            raise JobCancelled(f"Job {self.id} cancelled")
+
+    def _save(self):
+        """Writes the state of the job for other processes."""
+        state = dict(self.to_dict(), pid=os.getpid(), created=self._created)
+        self._saved = time.time()
+        # each thread writes its own file, replacing the state at once
+        tmp_path = f"{self._path}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._path)
+
+
+class StoredJob:
+    def __init__(self, folder, job_id):
+        """
+        Class responsible for reporting a job run by another process, from the
+        state it wrote to the jobs folder.
+
+        :param folder: path where jobs are registered
+        :param job_id: id of the job
+        """
+        self.id = job_id
+        self._path, self._cancel_path = _job_paths(folder, job_id)
+
+    def cancel(self):
+        """Asks the job to stop at its next progress report."""
+        if self.to_dict()["status"] in ["queued", "running"]:
+            open(self._cancel_path, "w").close()
+
+    def to_dict(self):
+        """
+        Gets the last state written by the job, which is interrupted if its
+        process is gone before finishing it.
+
+        :return: dictionary with the job state
+        """
+        with open(self._path, "r") as f:
+            state = json.load(f)
+        pid = state.pop("pid")
+        created = state.pop("created")
+        if state["status"] in ["queued", "running"]:
+            if _is_alive(pid):
+                state["elapsed"] = time.time() - created
+            else:
+                state["status"] = "interrupted"
+        return state
+
+
+class JobManager:
+    def __init__(self, folder):
+        """
+        Class responsible for running indexing operations, in background
+        threads or in the calling thread, allowing a single writer job at a
+        time.
+
+        Jobs are registered in a folder shared by the processes of a server,
+        with the lock held by the writer job, so every process reports the
+        jobs of the others and refuses writers while one of them runs.
+
+        :param folder: path where jobs are registered
+        """
+        self._folder = folder
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._lock_file = None
+        os.makedirs(folder, exist_ok=True)
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Starts a writer job, unless another one is still running.
+
+        :param name: name of the operation
+        :param func: operation receiving a progress keyword argument
+        :param args: arguments of the operation
+        :param kwargs: keyword arguments of the operation
+        :return: the job started, or None if a writer job is running
+        """
+        job = self._claim(name)
+        if job is None:
+            return None
+        threading.Thread(
+            target=self._run,
+            args=(job, func, *args),
+            kwargs=kwargs,
+            daemon=True,
+        ).start()
+        return job
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs a writer job in the calling thread, unless another one is still
+        running.
+
+        :param name: name of the operation
+        :param func: operation receiving a progress keyword argument
+        :param args: arguments of the operation
+        :param kwargs: keyword arguments of the operation
+        :return: the finished job, or None if a writer job is running
+        """
+        job = self._claim(name)
+        if job is not None:
+            self._run(job, func, *args, **kwargs)
+        return job
+
+    def _claim(self, name):
+        """
+        Registers a writer job, unless another one is still running.
+
+        :param name: name of the operation
+        :return: the job registered, or None if a writer job is running
+        """
+        # the file lock excludes other processes, the thread lock other
+        # threads, as file locks are held by the whole process
+        if not self._lock.acquire(blocking=False):
+            return None
+        lock_file = open(f"{self._folder}/writer.lock", "w")
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            self._lock.release()
+            return None
+        self._lock_file = lock_file
+        try:
+            job = Job(name, self._folder)
+        except Exception:
+            self._release()
+            raise
+        self._jobs[job.id] = job
+        return job
+
+    def _run(self, job, func, *args, **kwargs):
+        """
+        Runs a claimed job, releasing the writer lock when it's finished.
+
+        :param job: job returned by _claim
+        :param func: operation receiving a progress keyword argument
+        :param args: arguments of the operation
+        :param kwargs: keyword arguments of the operation
+        """
+        try:
+            job.run(func, *args, **kwargs)
+        finally:
+            self._release()
+
+    def _release(self):
+        """Releases the writer lock."""
+        self._lock_file.close()
+        self._lock_file = None
+        self._lock.release()
+
+    def get(self, job_id):
+        """
+        Gets a job by id, run by this process or another one.
+
+        :param job_id: id of the job
+        :return: the job or None if it doesn't exist
+        """
+        if job_id in self._jobs:
+            return self._jobs[job_id]
+        if not re.fullmatch("[0-9a-f]{32}", job_id):
+            return None
+        if not os.path.exists(_job_paths(self._folder, job_id)[0]):
+            return None
+        return StoredJob(self._folder, job_id)
+
+
+def _job_paths(folder, job_id):
+    """
+    Gets the files of a job.
+
+    :param folder: path where jobs are registered
+    :param job_id: id of the job
+    :return: tuple with the paths of the state and cancel files
+    """
+    return f"{folder}/{job_id}.json", f"{folder}/{job_id}.cancel"
+
+
+def _is_alive(pid):
+    """
+    Checks whether a process is running.
+
+    :param pid: id of the process
+    :return: if the process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,114 @@
+import re
+from collections import deque
+
+# characters with special meaning in a regular expression
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+class KeywordMatcher:
+    def __init__(self, keywords):
+        """
+        Class responsible for finding occurrences of many keywords in a text
+        with a single pass, using an Aho-Corasick automaton.
+
+        Occurrences are reported with the same semantics as calling
+        `re.finditer(keyword, text)` for each keyword: matches of the same
+        keyword never overlap, while matches of different keywords may.
+
+        :param keywords: iterable of keywords to be searched
+        """
+        self._keywords = []
+        self._patterns = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        seen = set()
+        for kw in keywords:
+            if kw in seen:
+                continue
+            seen.add(kw)
+            self._keywords.append(kw)
+            # keywords using regex syntax can't be matched literally
+            if not kw or REGEX_METACHARACTERS.intersection(kw):
+                self._patterns.append(kw)
+            else:
+                self._add_keyword(kw)
+        self._build_failure_links()
+
+    @property
+    def keywords(self):
+        """Unique keywords known by the matcher, in insertion order."""
+        return self._keywords
+
+    def iter_matches(self, text):
+        """
+        Finds occurrences of every keyword in the text.
+
+        :param text: text to be scanned
+        :return: generator of (start, end, keyword) tuples
+        """
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        # end position of the last match of each keyword, as re.finditer
+        # resumes scanning after the end of the previous match
+        last_end = {}
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for kw in output[state]:
+                end = i + 1
+                start = end - len(kw)
+                if start >= last_end.get(kw, 0):
+                    last_end[kw] = end
+                    yield start, end, kw
+        for kw in self._patterns:
+            for t in re.finditer(kw, text):
+                yield t.start(), t.end(), kw
+
+    def count(self, text):
+        """
+        Counts occurrences of every keyword in the text.
+
+        :param text: text to be scanned
+        :return: dictionary with number of occurrences of each keyword found
+        """
+        counts = {}
+        for _, _, kw in self.iter_matches(text):
+            counts[kw] = counts.get(kw, 0) + 1
+        return counts
+
+    def _add_keyword(self, keyword):
+        """
+        Inserts a keyword in the automaton trie.
+
+        :param keyword: keyword to be inserted
+        """
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append(keyword)
+
+    def _build_failure_links(self):
+        """Computes failure links of the automaton with a breadth first walk."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._output[nxt] = (
+                    self._output[nxt] + self._output[self._fail[nxt]]
+                )
@@ -0,0 +1,498 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from glob import glob
+
+# upper bounds in seconds of histogram buckets, from fast queries to ocr
+DEFAULT_BUCKETS = [
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+]
+
+
+class Registry:
+    def __init__(self):
+        """
+        Class responsible for keeping metrics and rendering them in the
+        Prometheus text format.
+
+        Metrics recorded in worker processes are sent back to the parent
+        process with the results of the workers, see collect and merged.
+        Processes serving the same metrics, e.g. the workers of a server,
+        share their values through files in a folder, see share.
+        """
+        self._metrics = []
+        self._folder = None
+        self._path = None
+        self._pid = None
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry.
+
+        :param metric: counter or histogram
+        :return: the metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders every metric.
+
+        :return: metrics in the Prometheus text exposition format
+        """
+        shared = self._read_shared() if self._folder else {}
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(shared.get(metric.name)))
+        return "\n".join(lines) + "\n"
+
+    def share(self, folder, interval=5):
+        """
+        Shares the values of this process with the other processes sharing
+        the folder, writing them every interval seconds and on exit, and
+        renders the values of all of them.
+
+        Files of finished processes are kept, so counters don't go back
+        when a process is replaced.
+
+        :param folder: path where values are shared
+        :param interval: seconds between writes
+        """
+        os.makedirs(folder, exist_ok=True)
+        self._folder = folder
+        # pids may be reused by processes replacing finished ones
+        self._path = f"{folder}/{uuid.uuid4().hex}.json"
+        self._pid = os.getpid()
+        self.dump()
+        atexit.register(self.dump)
+        threading.Thread(
+            target=self._dump_every, args=(interval,), daemon=True
+        ).start()
+
+    def dump(self):
+        """Writes the values of this process to the shared folder."""
+        # processes forked from a sharing one keep their values to themselves
+        if self._folder is None or os.getpid() != self._pid:
+            return
+        values = {m.name: m.encode() for m in self._metrics}
+        tmp_path = f"{self._path}.{threading.get_ident()}"
+        with open(tmp_path, "w") as f:
+            json.dump(values, f)
+        os.replace(tmp_path, self._path)
+
+    def flush(self):
+        """
+        Gets the values recorded since the last flush, resetting them.
+
+        :return: dictionary with the values of each metric by name
+        """
+        return {m.name: m.flush() for m in self._metrics}
+
+    def merge(self, values):
+        """
+        Adds values recorded by another process.
+
+        :param values: values returned by flush
+        """
+        for metric in self._metrics:
+            if values.get(metric.name):
+                metric.merge(values[metric.name])
+
+    def reset(self):
+        """Discards every recorded value."""
+        self.flush()
+
+    def _dump_every(self, interval):
+        """
+        Writes the values of this process periodically.
+
+        :param interval: seconds between writes
+        """
+        while True:
+            time.sleep(interval)
+            self.dump()
+
+    def _read_shared(self):
+        """
+        Adds the values of every process sharing the folder.
+
+        :return: dictionary with the values of each metric by name
+        """
+        self.dump()
+        metrics = {m.name: m for m in self._metrics}
+        shared = {name: {} for name in metrics}
+        for path in glob(f"{self._folder}/*.json"):
+            try:
+                with open(path, "r") as f:
+                    values = json.load(f)
+            except FileNotFoundError:
+                continue
+            for name, encoded in values.items():
+                if name in metrics:
+                    metric = metrics[name]
+                    metric.add(shared[name], metric.decode(encoded))
+        return shared
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        Base class of metrics, keeping a value for each combination of labels.
+
+        :param name: name of the metric
+        :param description: help text of the metric
+        :param labels: names of the labels of the metric
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self, values=None):
+        """
+        Renders the metric.
+
+        :param values: values to render instead of the recorded ones
+        :return: lines in the Prometheus text exposition format
+        """
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        if values is None:
+            with self._lock:
+                values = {k: self._copy(v) for k, v in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def flush(self):
+        """
+        Gets the recorded values, resetting them.
+
+        :return: dictionary with the value of each combination of labels
+        """
+        with self._lock:
+            values = self._values
+            self._values = {}
+        return values
+
+    def merge(self, values):
+        """
+        Adds recorded values.
+
+        :param values: values returned by flush
+        """
+        with self._lock:
+            self.add(self._values, values)
+
+    def add(self, values, other):
+        """
+        Adds values to others.
+
+        :param values: dictionary updated with the sum
+        :param other: values to add
+        """
+        raise NotImplementedError
+
+    def encode(self):
+        """
+        Gets the recorded values in a json serializable form.
+
+        :return: list of label values and value pairs
+        """
+        with self._lock:
+            return [[list(k), self._copy(v)] for k, v in self._values.items()]
+
+    def decode(self, encoded):
+        """
+        Gets values from their json serializable form.
+
+        :param encoded: values returned by encode
+        :return: dictionary with the value of each combination of labels
+        """
+        return {tuple(key): value for key, value in encoded}
+
+    def _copy(self, value):
+        """
+        Copies a value, so it can be read while others are recorded.
+
+        :param value: recorded value
+        :return: copy of the value
+        """
+        return value
+
+    def _key(self, labels):
+        """
+        Gets the values of the labels, in the order they were declared.
+
+        :param labels: value of each label
+        :return: tuple of label values
+        """
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key, extra=None):
+        """
+        Formats label values as a Prometheus label set.
+
+        :param key: tuple of label values
+        :param extra: additional label name and value
+        :return: label set, empty if there are no labels
+        """
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        labels = ",".join(f'{n}="{self._escape(v)}"' for n, v in pairs)
+        return "{" + labels + "}"
+
+    def _escape(self, value):
+        """
+        Escapes a label value.
+
+        :param value: label value
+        :return: escaped value
+        """
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+        return value.replace("\n", "\\n")
+
+    def _render_value(self, key, value):
+        """
+        Renders the value of a combination of labels.
+
+        :param key: tuple of label values
+        :param value: recorded value
+        :return: lines in the Prometheus text exposition format
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increments the counter.
+
+        :param amount: value to add
+        :param labels: value of each label
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def add(self, values, other):
+        for key, value in other.items():
+            values[key] = values.get(key, 0) + value
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=None):
+        """
+        Class responsible for counting observations in buckets, e.g. of
+        durations.
+
+        :param name: name of the metric
+        :param description: help text of the metric
+        :param labels: names of the labels of the metric
+        :param buckets: upper bounds of the buckets
+        """
+        super().__init__(name, description, labels)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value, **labels):
+        """
+        Records an observation.
+
+        :param value: observed value
+        :param labels: value of each label
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0)
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Records the duration of a block, in seconds.
+
+        :param labels: value of each label
+        :return: context manager timing the block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def add(self, values, other):
+        for key, (counts, total) in other.items():
+            current, current_total = values.get(
+                key, ([0] * (len(self.buckets) + 1), 0)
+            )
+            counts = [a + b for a, b in zip(current, counts)]
+            values[key] = (counts, current_total + total)
+
+    def _copy(self, value):
+        # counts are updated in place
+        counts, total = value
+        return list(counts), total
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            labels = self._format_labels(key, ("le", bound))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = self._format_labels(key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def init_worker():
+    """Discards values inherited by a worker process from its parent."""
+    REGISTRY.reset()
+
+
+def collect(func, *args):
+    """
+    Runs a function in a worker process, returning the metrics it recorded
+    along with its result.
+
+    :param func: function to run
+    :param args: arguments of the function
+    :return: tuple with the result and the recorded values
+    """
+    result = func(*args)
+    return result, REGISTRY.flush()
+
+
+def merged(results):
+    """
+    Adds the metrics recorded by worker processes, as results arrive.
+
+    :param results: iterable of results returned by collect
+    :return: generator of the results of the function
+    """
+    for result, values in results:
+        REGISTRY.merge(values)
+        yield result
+
+
+REGISTRY = Registry()
+
+EXTRACTED_FILES = REGISTRY.register(
+    Counter(
+        "deepdoc_extracted_files_total",
+        "Pdf files processed by text extraction.",
+        ["method", "status"],
+    )
+)
+EXTRACTION_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_extraction_seconds",
+        "Time to extract the text of a pdf file.",
+        ["method"],
+    )
+)
+EXTRACTED_PAGES = REGISTRY.register(
+    Counter(
+        "deepdoc_extracted_pages_total",
+        "Pages processed by page level text extraction.",
+        ["method", "status"],
+    )
+)
+PAGE_EXTRACTION_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_page_extraction_seconds",
+        "Time to extract the text of a page of a pdf file.",
+        ["method"],
+    )
+)
+TAGGING_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_tagging_seconds",
+        "Time to read, normalize and tag a document.",
+    )
+)
+WRITER_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_writer_seconds",
+        "Time of index writer operations.",
+        ["operation"],
+    )
+)
+SEARCHER_OPEN_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_searcher_open_seconds",
+        "Time to open the index and searchers, or refresh searchers.",
+        ["operation"],
+    )
+)
+QUERIES = REGISTRY.register(
+    Counter(
+        "deepdoc_queries_total",
+        "Searches performed, by type and results cache usage.",
+        ["type", "cache"],
+    )
+)
+QUERY_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_query_seconds",
+        "Total time of searches not answered by the cache.",
+        ["type"],
+    )
+)
+QUERY_PHASE_SECONDS = REGISTRY.register(
+    Histogram(
+        "deepdoc_query_phase_seconds",
+        "Time of each phase of a search.",
+        ["phase"],
+    )
+)
+SLOW_QUERIES = REGISTRY.register(
+    Counter(
+        "deepdoc_slow_queries_total",
+        "Searches slower than the slow query threshold.",
+        ["type"],
+    )
+)
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+
+# maximum size in bytes of the excerpts kept on disk
+CACHE_MAX_BYTES = 512 * 2**20
+# highest page number accepted, pages are listed before the file is read
+MAX_PAGE = 100000
+
+
+def parse_pages(pages_str, max_page=MAX_PAGE):
+    """
+    Parses a list of pages and ranges of pages, e.g. 1,3-5.
+
+    :param pages_str: comma separated pages and ranges of pages
+    :param max_page: highest page number accepted
+    :return: sorted list of page numbers
+    """
+    pages = set()
+    for part in pages_str.split(","):
+        first, _, last = part.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid pages: {part}")
+        # ranges are checked before being expanded
+        if last > max_page:
+            raise ValueError(f"Pages after {max_page} are not supported")
+        pages.update(range(first, last + 1))
+    return sorted(pages)
+
+
+class PdfPages:
+    def __init__(self, folder, max_bytes=CACHE_MAX_BYTES):
+        """
+        Class responsible for cutting pages out of pdf files, keeping the
+        resulting excerpts on disk and removing the least recently used ones
+        when they exceed a size.
+
+        :param folder: path where the excerpts will be kept
+        :param max_bytes: maximum size of the excerpts kept
+        """
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def excerpt(self, pdf_file, pages):
+        """
+        Gets a pdf file with only some pages of another, cutting it if it's
+        not kept yet.
+
+        :param pdf_file: path to the pdf file
+        :param pages: sorted list of page numbers, pages after the last one of the file are ignored
+        :return: path to the excerpt
+        """
+        path = f"{self._folder}/{self._key(pdf_file, pages)}.pdf"
+        try:
+            # access time is kept as modification time, to find the least
+            # recently used excerpts
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        count = self._count_pages(pdf_file)
+        pages = [p for p in pages if p <= count]
+        if not pages:
+            raise ValueError(f"{pdf_file} has only {count} pages")
+        with tempfile.TemporaryDirectory(dir=self._folder) as folder:
+            files = []
+            for first, last in self._ranges(pages):
+                self._run(
+                    [
+                        "pdfseparate",
+                        "-f",
+                        str(first),
+                        "-l",
+                        str(last),
+                        pdf_file,
+                        f"{folder}/page-%d.pdf",
+                    ]
+                )
+                files.extend(
+                    f"{folder}/page-{p}.pdf" for p in range(first, last + 1)
+                )
+            if len(files) == 1:
+                os.replace(files[0], f"{folder}/excerpt.pdf")
+            else:
+                self._run(["pdfunite", *files, f"{folder}/excerpt.pdf"])
+            # the excerpt appears at once for concurrent requests
+            os.replace(f"{folder}/excerpt.pdf", path)
+        self._evict(keep=path)
+        return path
+
+    def _key(self, pdf_file, pages):
+        """
+        Gets the name of the excerpt of a version of a pdf file.
+
+        :param pdf_file: path to the pdf file
+        :param pages: sorted list of page numbers
+        :return: hash of the file, its version and the pages
+        """
+        stat = os.stat(pdf_file)
+        key = [os.path.realpath(pdf_file), stat.st_mtime_ns, stat.st_size]
+        key.append(",".join(str(p) for p in pages))
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def _ranges(self, pages):
+        """
+        Groups consecutive pages.
+
+        :param pages: sorted list of page numbers
+        :return: list of tuples with the first and last page of each range
+        """
+        ranges = []
+        for page in pages:
+            if ranges and ranges[-1][1] == page - 1:
+                ranges[-1] = (ranges[-1][0], page)
+            else:
+                ranges.append((page, page))
+        return ranges
+
+    def _evict(self, keep):
+        """
+        Removes the least recently used excerpts until they fit the maximum
+        size.
+
+        :param keep: path to the excerpt just created
+        """
+        with self._lock:
+            excerpts = []
+            for entry in os.scandir(self._folder):
+                if entry.is_file() and entry.name.endswith(".pdf"):
+                    stat = entry.stat()
+                    excerpts.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in excerpts)
+            for _, size, path in sorted(excerpts):
+                if total <= self._max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def _count_pages(self, pdf_file):
+        """
+        Counts the pages of a pdf file.
+
+        :param pdf_file: path to the pdf file
+        :return: number of pages
+        """
+        for line in self._run(["pdfinfo", pdf_file]).splitlines():
+            if line.startswith("Pages:"):
+                return int(line.split()[-1])
+        raise ValueError(f"Unable to count pages of {pdf_file}")
+
+    def _run(self, args):
+        """
+        Runs an external command.
+
+        :param args: command and its arguments
+        :return: decoded output of the command
+        """
+        output = subprocess.run(
+            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        )
+        return output.stdout.decode("utf-8")
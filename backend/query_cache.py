@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    def __init__(self, max_size=256, ttl=300):
+        """
+        Class responsible for caching search results, bounded in size and age
+        and tied to the generation of the index they were computed on.
+
+        :param max_size: maximum number of cached results, least recently used are evicted first
+        :param ttl: seconds a cached result is considered valid
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = None
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, generation):
+        """
+        Gets a cached result.
+
+        :param key: key of the result
+        :param generation: current generation of the index
+        :return: cached result or None if it's not cached
+        """
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self._ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, generation, value):
+        """
+        Caches a result.
+
+        :param key: key of the result
+        :param generation: generation of the index the result was computed on
+        :param value: result to be cached
+        """
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """Removes every cached result."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Gets usage statistics of the cache.
+
+        :return: dictionary with hits, misses, evictions and size of the cache
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "size": len(self._entries),
+                "max_size": self._max_size,
+                "ttl": self._ttl,
+            }
+
+    def _check_generation(self, generation):
+        """
+        Invalidates cached results if the index changed generation.
+
+        :param generation: current generation of the index
+        """
+        if generation != self._generation:
+            self._entries.clear()
+            self._generation = generation
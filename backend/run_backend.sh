@@ -1,3 +1,8 @@
 #!/bin/bash
 
-FLASK_APP=app.py FLASK_ENV=development flask run
+# ./run_backend.sh production serves the app with multiple workers
+if [ "$1" = "production" ]; then
+    python serve.py
+else
+    FLASK_APP=app.py FLASK_ENV=development flask run
+fi
@@ -0,0 +1,100 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import metrics
+from whoosh.index import open_dir
+from whoosh.scoring import Frequency
+
+
+class SearcherPool:
+    def __init__(self, index_folder, size=None):
+        """
+        Class responsible for keeping an index and a pool of searchers open for
+        the life of the process, so queries don't reopen the index.
+
+        Each searcher is used by a single thread at a time and is refreshed
+        when the index has a newer generation than the one it was opened on.
+
+        :param index_folder: path where the index is located
+        :param size: maximum number of searchers, defaults to number of cpus
+        """
+        self._index_folder = index_folder
+        self._size = size or os.cpu_count()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self._size)
+        self._idle = queue.LifoQueue()
+        self._index = None
+
+    @property
+    def index(self):
+        """Index shared by every searcher, opened on first use."""
+        with self._lock:
+            if self._index is None:
+                with metrics.SEARCHER_OPEN_SECONDS.time(operation="index"):
+                    self._index = open_dir(f"{self._index_folder}")
+            return self._index
+
+    def generation(self):
+        """
+        Gets the latest generation of the index.
+
+        :return: generation number
+        """
+        return self.index.latest_generation()
+
+    @contextmanager
+    def searcher(self):
+        """
+        Borrows a searcher from the pool, refreshing it if it's outdated.
+
+        :return: context manager yielding a searcher
+        """
+        self._slots.acquire()
+        searcher = None
+        try:
+            try:
+                searcher = self._idle.get_nowait()
+            except queue.Empty:
+                index = self.index
+                with metrics.SEARCHER_OPEN_SECONDS.time(operation="open"):
+                    searcher = index.searcher(weighting=Frequency())
+            else:
+                # picks up segments committed since the searcher was opened
+                with metrics.SEARCHER_OPEN_SECONDS.time(operation="refresh"):
+                    searcher = searcher.refresh()
+            yield searcher
+        finally:
+            if searcher is not None:
+                self._idle.put(searcher)
+            self._slots.release()
+
+    def refresh(self):
+        """Refreshes idle searchers after the index received a commit."""
+        searchers = self._drain()
+        for searcher in searchers:
+            self._idle.put(searcher.refresh())
+
+    def reset(self):
+        """Closes the index and every idle searcher, e.g. after recreating the
+        index."""
+        for searcher in self._drain():
+            searcher.close()
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+            self._index = None
+
+    def _drain(self):
+        """
+        Removes every idle searcher from the pool.
+
+        :return: list of idle searchers
+        """
+        searchers = []
+        while True:
+            try:
+                searchers.append(self._idle.get_nowait())
+            except queue.Empty:
+                return searchers
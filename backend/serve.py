@@ -0,0 +1,112 @@
+import os
+import signal
+from glob import glob
+
+from gunicorn.app.base import BaseApplication
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        """
+        Class responsible for serving the app with multiple worker processes.
+
+        The app, with the keywords vocabulary, tag maps and search cache, is
+        built and warmed up once before workers are forked, so they share it
+        copy-on-write. Each worker then opens its own searchers and warms
+        them up, reporting ready on /health when it's done. Workers share
+        their metrics through files in METRICS_DIR, so any of them renders
+        the metrics of the whole server.
+
+        :param options: gunicorn settings
+        """
+        self._options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self._options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        # metrics of a previous run of the server start over
+        for path in glob(f"{get_metrics_folder()}/*.json"):
+            os.remove(path)
+        import app
+
+        app.warm_up()
+        return app.app
+
+
+def post_fork(server, worker):
+    """
+    Prepares the app inherited by a worker process.
+
+    :param server: gunicorn arbiter
+    :param worker: worker process
+    """
+    import app
+    import metrics
+
+    metrics.init_worker()
+    metrics.REGISTRY.share(get_metrics_folder())
+    # processes forked by the worker, e.g. tagging pools, don't inherit its
+    # handler of the termination signal, which would keep them alive when
+    # their pool terminates them, and the signal is blocked while forking
+    # so it's not received before the handler is restored
+    os.register_at_fork(
+        before=_block_termination,
+        after_in_parent=_unblock_termination,
+        after_in_child=_restore_termination,
+    )
+    app.indexer.after_fork()
+    app.start_warm_up()
+
+
+def _block_termination():
+    """Delays the termination signal received by the current thread."""
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGTERM])
+
+
+def _unblock_termination():
+    """Receives the termination signal delayed by _block_termination."""
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGTERM])
+
+
+def _restore_termination():
+    """Restores the default handler of the termination signal, then receives
+    it."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _unblock_termination()
+
+
+def get_metrics_folder():
+    """
+    Gets the folder where workers share their metrics.
+
+    :return: path of the folder
+    """
+    return os.environ.get("METRICS_DIR", "index-directory/metrics")
+
+
+def get_options():
+    """
+    Gets the server settings from the environment.
+
+    :return: gunicorn settings
+    """
+    # workers are replaced after WEB_MAX_REQUESTS requests, if set
+    max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+    return {
+        "bind": os.environ.get("BIND", "0.0.0.0:5000"),
+        "workers": int(os.environ.get("WEB_WORKERS", os.cpu_count())),
+        # threads keep workers responsive during long indexing requests
+        "worker_class": "gthread",
+        "threads": int(os.environ.get("WEB_THREADS", 4)),
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests // 10,
+        "preload_app": True,
+        "post_fork": post_fork,
+    }
+
+
+if __name__ == "__main__":
+    Server(get_options()).run()
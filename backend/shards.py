@@ -0,0 +1,88 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def shard_of(path, count):
+    """
+    Gets the shard a document belongs to, by the hash of its path.
+
+    :param path: unique path of the document
+    :param count: number of shards
+    :return: index of the shard
+    """
+    if count == 1:
+        return 0
+    digest = hashlib.sha256(path.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class ShardedWriter:
+    def __init__(self, writers):
+        """
+        Class responsible for routing documents to the writer of the shard
+        they belong to, with the same interface as a whoosh writer.
+
+        :param writers: writer of each shard
+        """
+        self._writers = writers
+
+    @property
+    def schema(self):
+        """Schema shared by every shard."""
+        return self._writers[0].schema
+
+    @property
+    def is_closed(self):
+        """Whether every shard was committed or cancelled."""
+        return all(writer.is_closed for writer in self._writers)
+
+    def add_document(self, **fields):
+        """
+        Adds a document to its shard.
+
+        :param fields: fields of the document, including its path
+        """
+        self._writer_of(fields["path"]).add_document(**fields)
+
+    def update_document(self, **fields):
+        """
+        Replaces a document in its shard, by its unique path.
+
+        :param fields: fields of the document, including its path
+        """
+        self._writer_of(fields["path"]).update_document(**fields)
+
+    def delete_by_term(self, fieldname, text):
+        """
+        Deletes documents matching a term, only from their shard if the term
+        is a path.
+
+        :param fieldname: name of the field
+        :param text: value of the term
+        """
+        if fieldname == "path":
+            self._writer_of(text).delete_by_term(fieldname, text)
+            return
+        for writer in self._writers:
+            writer.delete_by_term(fieldname, text)
+
+    def commit(self):
+        """Commits every shard in parallel."""
+        with ThreadPoolExecutor(len(self._writers)) as executor:
+            # raises the error of any shard that failed
+            list(executor.map(lambda w: w.commit(), self._writers))
+
+    def cancel(self):
+        """Cancels the documents added to every shard not yet committed."""
+        for writer in self._writers:
+            if not writer.is_closed:
+                writer.cancel()
+
+    def _writer_of(self, path):
+        """
+        Gets the writer of the shard of a document.
+
+        :param path: unique path of the document
+        :return: whoosh writer
+        """
+        return self._writers[shard_of(path, len(self._writers))]
@@ -0,0 +1,264 @@
+import collections
+import multiprocessing
+import os
+import resource
+import signal
+import time
+from multiprocessing.connection import wait
+
+# workers close the connections inherited from the supervisor, so it needs
+# them to be forked rather than spawned
+_context = multiprocessing.get_context("fork")
+
+
+def limit_memory(memory_mb):
+    """
+    Limits the address space of the current process and of the processes it
+    starts, so a task using too much memory fails instead of the machine.
+
+    :param memory_mb: maximum memory in megabytes, no limit if None
+    """
+    if memory_mb:
+        limit = memory_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _work(func, conn, inherited, memory_mb, initializer):
+    """
+    Runs tasks received from the supervisor until it closes the connection.
+
+    :param func: function applied to each task
+    :param conn: connection to the supervisor
+    :param inherited: supervisor ends of the connections of every worker
+    :param memory_mb: maximum memory of the worker in megabytes
+    :param initializer: function called when the worker starts
+    """
+    # only the supervisor keeps its ends open, so the worker sees the
+    # connection closed when the supervisor stops it or exits
+    for supervisor_conn in inherited:
+        supervisor_conn.close()
+    # external tools started by the worker are killed along with it
+    os.setsid()
+    limit_memory(memory_mb)
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        try:
+            outcome = ("done", func(item), None)
+        except Exception as e:
+            outcome = ("failed", None, repr(e))
+        conn.send(outcome)
+
+
+class _Worker:
+    def __init__(self, func, others, memory_mb, initializer):
+        """
+        Process running tasks of a supervised pool, one at a time.
+
+        :param func: function applied to each task
+        :param others: workers already running
+        :param memory_mb: maximum memory of the worker in megabytes
+        :param initializer: function called when the worker starts
+        """
+        self.conn, child_conn = _context.Pipe()
+        inherited = [self.conn] + [w.conn for w in others]
+        self.process = _context.Process(
+            target=_work,
+            args=(func, child_conn, inherited, memory_mb, initializer),
+            daemon=True,
+        )
+        self.process.start()
+        # the worker holds the only other end, so its exit is noticed
+        child_conn.close()
+        self.tasks = 0
+        self.item = None
+        self.attempts = 0
+        self.started = None
+
+    def submit(self, item, attempts):
+        """
+        Sends a task to the worker.
+
+        :param item: task
+        :param attempts: number of previous attempts of the task
+        """
+        self.item = item
+        self.attempts = attempts
+        self.started = time.monotonic()
+        self.conn.send(item)
+
+    def stop(self, kill=False):
+        """
+        Stops the worker.
+
+        :param kill: whether to kill the worker and the processes it started instead of letting it finish
+        """
+        if kill:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                self.process.kill()
+        self.conn.close()
+        self.process.join()
+
+
+class SupervisedPool:
+    def __init__(
+        self,
+        processes,
+        timeout=None,
+        memory_mb=None,
+        tasks_per_worker=None,
+        retries=0,
+        initializer=None,
+    ):
+        """
+        Class responsible for running tasks in worker processes that are
+        killed when a task takes too long, so a single task can't stall the
+        others.
+
+        Workers are replaced after a number of tasks, to release memory
+        accumulated by long runs, and after being killed or crashing. Tasks
+        that timed out or crashed their worker are tried again.
+
+        :param processes: number of worker processes
+        :param timeout: maximum seconds of a task, no limit if None
+        :param memory_mb: maximum memory of each worker in megabytes, including the processes it starts, no limit if None
+        :param tasks_per_worker: number of tasks after which a worker is replaced, never replaced if None
+        :param retries: number of times a task that timed out or crashed is tried again
+        :param initializer: function called when each worker starts
+        """
+        self._processes = processes
+        self._timeout = timeout
+        self._memory_mb = memory_mb
+        self._tasks_per_worker = tasks_per_worker
+        self._retries = retries
+        self._initializer = initializer
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stops every worker, killing the ones still running a task."""
+        for worker in self._workers:
+            worker.stop(kill=worker.item is not None)
+        self._workers = []
+
+    def imap_unordered(self, func, items):
+        """
+        Applies a function to every task, yielding outcomes as tasks finish.
+
+        :param func: function applied to each task
+        :param items: tasks
+        :return: generator of tuples with the task, its status (done, failed, timeout or crashed), the result of the function, the error and the number of attempts
+        """
+        pending = collections.deque((item, 0) for item in items)
+        try:
+            while pending or self._busy():
+                while pending:
+                    worker = self._idle_worker(func)
+                    if worker is None:
+                        break
+                    worker.submit(*pending.popleft())
+                busy = self._busy()
+                ready = wait([w.conn for w in busy], self._wait_timeout(busy))
+                for worker in busy:
+                    item, attempts = worker.item, worker.attempts + 1
+                    if worker.conn in ready:
+                        outcome = self._receive(worker)
+                    elif self._expired(worker):
+                        worker.stop(kill=True)
+                        self._workers.remove(worker)
+                        error = f"no result after {self._timeout} seconds"
+                        outcome = ("timeout", None, error)
+                    else:
+                        continue
+                    worker.item = None
+                    status, result, error = outcome
+                    if status in ("timeout", "crashed"):
+                        if attempts <= self._retries:
+                            pending.append((item, attempts))
+                            continue
+                    yield item, status, result, error, attempts
+        finally:
+            self.close()
+
+    def _receive(self, worker):
+        """
+        Receives the outcome of the task of a worker, replacing the worker
+        if it exited or ran enough tasks.
+
+        :param worker: worker with a finished task
+        :return: tuple with the status, result and error of the task
+        """
+        try:
+            outcome = worker.conn.recv()
+        except (EOFError, OSError):
+            worker.process.join()
+            error = f"worker exited with code {worker.process.exitcode}"
+            worker.stop()
+            self._workers.remove(worker)
+            return "crashed", None, error
+        worker.tasks += 1
+        if self._tasks_per_worker and worker.tasks >= self._tasks_per_worker:
+            worker.stop()
+            self._workers.remove(worker)
+        return outcome
+
+    def _idle_worker(self, func):
+        """
+        Gets a worker without a task, starting one if there are fewer than
+        the number of processes.
+
+        :param func: function applied to each task
+        :return: worker, or None if every worker is busy
+        """
+        for worker in self._workers:
+            if worker.item is None:
+                return worker
+        if len(self._workers) < self._processes:
+            worker = _Worker(
+                func, self._workers, self._memory_mb, self._initializer
+            )
+            self._workers.append(worker)
+            return worker
+        return None
+
+    def _busy(self):
+        """
+        Gets the workers running a task.
+
+        :return: list of workers
+        """
+        return [w for w in self._workers if w.item is not None]
+
+    def _expired(self, worker):
+        """
+        Checks if the task of a worker exceeded the timeout.
+
+        :param worker: busy worker
+        :return: whether the task timed out
+        """
+        if self._timeout is None:
+            return False
+        return time.monotonic() - worker.started >= self._timeout
+
+    def _wait_timeout(self, busy):
+        """
+        Gets how long to wait for tasks to finish before checking timeouts.
+
+        :param busy: workers running a task
+        :return: seconds until the first task times out, None to wait indefinitely
+        """
+        if self._timeout is None:
+            return None
+        deadline = min(w.started for w in busy) + self._timeout
+        return max(deadline - time.monotonic(), 0)
@@ -0,0 +1,103 @@
+import json
+import random
+
+import pytest
+from catalog import Catalog
+from indexer_whoosh import Indexer
+from whoosh.index import open_dir
+from whoosh.qparser import QueryParser
+
+# words sharing substrings, with stopwords and separators phrases may
+# match across
+WORDS = [
+    "petroleo",
+    "oleo",
+    "oleoduto",
+    "bruto",
+    "gas",
+    "gasoso",
+    "natural",
+    "bacia",
+    "campos",
+    "de",
+    "a",
+    "o",
+]
+SEPARATORS = [" ", " ", " ", ", ", ". ", "; ", "\n"]
+TERMS = WORDS + ["leo", "gaso", "oleo bruto", "gas natural", "bacia de"]
+
+
+def _search_original(indexer, index_folder, query_json):
+    """
+    Performs an advanced search as the indexer did before building a query
+    tree, finding documents with any phrase of the query and checking its
+    terms as substrings of their content.
+
+    :param indexer: indexer whose index is searched
+    :param index_folder: path of the index
+    :param query_json: dictionary with query parameters
+    :return: sorted titles of the documents found
+    """
+    query_str = " OR ".join(
+        f'"{indexer._normalize_text(term)}"'
+        for terms in query_json.values()
+        for term in terms
+    )
+    titles = []
+    with open_dir(index_folder).searcher() as searcher:
+        query = QueryParser("content", searcher.schema).parse(query_str)
+        for hit in searcher.search(query, limit=None):
+            content = hit["content"]
+            if all(
+                indexer._normalize_text(term) in content
+                for term in query_json["AND"]
+            ) and not any(
+                indexer._normalize_text(term) in content
+                for term in query_json["NOT"]
+            ):
+                titles.append(hit["title"])
+    return sorted(titles)
+
+
+def _random_content(rng):
+    parts = []
+    for _ in range(rng.randint(3, 40)):
+        parts.append(rng.choice(WORDS))
+        parts.append(rng.choice(SEPARATORS))
+    return "".join(parts)
+
+
+def _random_query(rng):
+    return {
+        restriction: rng.sample(TERMS, rng.randint(0, 2))
+        for restriction in ["AND", "OR", "NOT"]
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_advanced_search_matches_original(tmp_path, monkeypatch, seed):
+    rng = random.Random(seed)
+    monkeypatch.chdir(tmp_path)
+    for folder in ["keywords", "docs", "index"]:
+        (tmp_path / folder).mkdir()
+    (tmp_path / "keywords" / "k.json").write_text(
+        json.dumps({"petroleo": ["petroleo"]})
+    )
+    (tmp_path / "tags.json").write_text(json.dumps({"petroleo": "assunto"}))
+    catalog = Catalog(str(tmp_path / "index"))
+    for i in range(80):
+        txt_path = tmp_path / "docs" / f"doc{i}.pdf.txt"
+        txt_path.write_text(_random_content(rng))
+        catalog.add(f"doc{i}.pdf", f"/pdfs/doc{i}.pdf", str(txt_path))
+    indexer = Indexer(
+        str(tmp_path / "docs"), str(tmp_path / "index"), cache_size=0
+    )
+    assert indexer.create_searchable_data()
+    for _ in range(100):
+        query_json = _random_query(rng)
+        results = json.loads(
+            indexer.search_documents(json.dumps(query_json), True, True)
+        )["results"]
+        assert sorted(r["title"] for r in results) == _search_original(
+            indexer, str(tmp_path / "index"), query_json
+        )
@@ -0,0 +1,131 @@
+import json
+import random
+import re
+from collections import defaultdict
+
+import pytest
+from indexer_whoosh import Indexer
+from keyword_matcher import KeywordMatcher
+
+# keywords using regex syntax, matched by the regex engine
+PATTERNS = ["ga.", "o.e", "(pre)?sal", "ab|ba", "c[ao]b", "a+b", "s\\.a"]
+# separators around keywords and characters they're made of, few enough
+# for keywords to overlap and share prefixes
+SEPARATORS = " .,;:/()[]'\""
+LETTERS = "abcos"
+
+
+def _tags_categories(indexer, content):
+    """
+    Infers document tags and categories scanning the content once for each
+    keyword, as the indexer did before using the keyword matcher.
+
+    :param indexer: indexer holding the vocabulary
+    :param content: document text
+    :return: document tags and categories
+    """
+    esc = "[](){}.,;:/~'\" "
+    keywords_frequency = {}
+    for kw in indexer._keywords_array:
+        positions = [
+            (t.start() - 1, t.end()) for t in re.finditer(kw, content)
+        ]
+        valid = 0
+        for s, e in positions:
+            if content[s] in esc and content[e] in esc:
+                valid += 1
+        if valid:
+            keywords_frequency[kw] = valid
+    tag_occurrences = defaultdict(int)
+    tags_frequency = []
+    for kw, f in keywords_frequency.items():
+        for t in indexer._get_keyword_tags(kw):
+            tag_occurrences[t] += f
+            tags_frequency.extend([t] * f)
+    categories_tags = defaultdict(list)
+    for t, f in tag_occurrences.items():
+        categories_tags[indexer._get_tag_category(t)].append((t, f))
+    for cat in categories_tags:
+        total = sum(f for _, f in categories_tags[cat])
+        thresh = 0.15 if cat in ["assunto", "escala"] else 0.00
+        categories_tags[cat] = [
+            x for x in categories_tags[cat] if x[1] / total >= thresh
+        ]
+    return (
+        ",".join(tags_frequency),
+        json.dumps(categories_tags, ensure_ascii=False),
+    )
+
+
+def _random_word(rng):
+    return "".join(rng.choice(LETTERS) for _ in range(rng.randint(1, 4)))
+
+
+def _random_keyword(rng):
+    kind = rng.random()
+    if kind < 0.15:
+        return rng.choice(PATTERNS)
+    if kind < 0.4:
+        # multi-word keywords
+        words = [_random_word(rng) for _ in range(rng.randint(2, 3))]
+        return " ".join(words)
+    return _random_word(rng)
+
+
+def _random_content(rng, keywords):
+    parts = []
+    for _ in range(rng.randint(0, 60)):
+        if rng.random() < 0.4:
+            parts.append(rng.choice(keywords))
+        else:
+            parts.append(_random_word(rng))
+        parts.append(rng.choice(SEPARATORS))
+    # content is padded with spaces when processed for indexation
+    return " " + "".join(parts) + " "
+
+
+def _make_indexer(tmp_path, monkeypatch, rng):
+    """
+    Creates an indexer with a random vocabulary in a temporary folder.
+
+    :return: the indexer and its keywords
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "keywords").mkdir(exist_ok=True)
+    tags = {
+        f"tag{i}": rng.choice(["assunto", "escala", "local"]) for i in range(6)
+    }
+    keywords = {
+        tag: [_random_keyword(rng) for _ in range(rng.randint(1, 6))]
+        for tag in tags
+    }
+    (tmp_path / "keywords" / "k.json").write_text(json.dumps(keywords))
+    (tmp_path / "tags.json").write_text(json.dumps(tags))
+    indexer = Indexer(str(tmp_path / "docs"), str(tmp_path / "index"))
+    return indexer, [kw for kws in keywords.values() for kw in kws]
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_tags_match_per_keyword_scan(tmp_path, monkeypatch, seed):
+    rng = random.Random(seed)
+    indexer, keywords = _make_indexer(tmp_path, monkeypatch, rng)
+    for _ in range(100):
+        content = _random_content(rng, keywords)
+        assert indexer._get_file_tags_categories(content) == (
+            _tags_categories(indexer, content)
+        )
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_are_the_same_as_finditer(seed):
+    rng = random.Random(seed)
+    keywords = [_random_keyword(rng) for _ in range(20)]
+    matcher = KeywordMatcher(keywords)
+    for _ in range(50):
+        content = _random_content(rng, keywords)
+        expected = sorted(
+            (t.start(), t.end(), kw)
+            for kw in set(keywords)
+            for t in re.finditer(kw, content)
+        )
+        assert sorted(matcher.iter_matches(content)) == expected
@@ -0,0 +1,105 @@
+import json
+import random
+
+import indexer_whoosh
+import pytest
+from catalog import Catalog
+from indexer_whoosh import Indexer
+
+# few words, so documents share terms and hits tie in score
+WORDS = [
+    "petroleo",
+    "oleo",
+    "bruto",
+    "gas",
+    "natural",
+    "bacia",
+    "campos",
+    "sal",
+    "pre-sal",
+    "oleoduto",
+    "gasoso",
+    "de",
+    "a",
+]
+SEPARATORS = [" ", " ", " ", ", ", ". ", "\n"]
+# terms searched, including prefixes and phrases of the words
+TERMS = WORDS + ["leo", "campo", "oleo bruto", "gas natural", "bacia de"]
+
+
+def _random_content(rng):
+    parts = []
+    for _ in range(rng.randint(3, 40)):
+        parts.append(rng.choice(WORDS))
+        parts.append(rng.choice(SEPARATORS))
+    return "".join(parts)
+
+
+def _random_query(rng):
+    kind = rng.random()
+    if kind < 0.2:
+        return {"TAG": [rng.choice(["petroleo", "gas", "local"])]}
+    query = {"AND": rng.sample(TERMS, rng.randint(1, 2))}
+    if kind < 0.6:
+        # advanced searches, with restrictions possibly left out
+        for restriction in ["OR", "NOT"]:
+            if rng.random() < 0.7:
+                query[restriction] = rng.sample(TERMS, rng.randint(0, 2))
+    return query
+
+
+def _make_indexer(tmp_path, monkeypatch, rng, **kwargs):
+    """
+    Creates an index of random documents in a temporary folder.
+
+    :return: the indexer
+    """
+    monkeypatch.chdir(tmp_path)
+    for folder in ["keywords", "docs", "index"]:
+        (tmp_path / folder).mkdir()
+    keywords = {
+        "petroleo": ["petroleo", "oleo bruto"],
+        "gas": ["gas natural", "gasoso"],
+        "local": ["bacia", "campos"],
+    }
+    tags = {"petroleo": "assunto", "gas": "assunto", "local": "local"}
+    (tmp_path / "keywords" / "k.json").write_text(json.dumps(keywords))
+    (tmp_path / "tags.json").write_text(json.dumps(tags))
+    catalog = Catalog(str(tmp_path / "index"))
+    for i in range(80):
+        txt_path = tmp_path / "docs" / f"doc{i}.pdf.txt"
+        txt_path.write_text(_random_content(rng))
+        catalog.add(f"doc{i}.pdf", f"/pdfs/doc{i}.pdf", str(txt_path))
+    indexer = Indexer(
+        str(tmp_path / "docs"), str(tmp_path / "index"), cache_size=0, **kwargs
+    )
+    assert indexer.create_searchable_data()
+    return indexer
+
+
+@pytest.mark.parametrize(
+    "kwargs,min_terms",
+    [({}, 64), ({}, 1), ({"store_content": False}, 1), ({"shards": 3}, 1)],
+)
+@pytest.mark.parametrize("seed", range(3))
+def test_batch_matches_single_searches(
+    tmp_path, monkeypatch, kwargs, min_terms, seed
+):
+    # terms are counted in a single pass from a number of distinct terms
+    monkeypatch.setattr(indexer_whoosh, "BATCH_MATCHER_MIN_TERMS", min_terms)
+    rng = random.Random(seed)
+    indexer = _make_indexer(tmp_path, monkeypatch, rng, **kwargs)
+    queries = [_random_query(rng) for _ in range(60)]
+    for page in [None, 1, 2]:
+        batch = json.loads(
+            indexer.search_documents_batch(json.dumps(queries), page, 5)
+        )["results"]
+        for query, result in zip(queries, batch):
+            terms = "TAG" not in query
+            advanced = terms and ("OR" in query or "NOT" in query)
+            if advanced:
+                query = {"AND": [], "OR": [], "NOT": [], **query}
+            single = indexer.search_documents(
+                json.dumps(query), terms, advanced, page, 5
+            )
+            assert result == json.loads(single)
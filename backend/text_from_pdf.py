@@ -1,90 +1,586 @@
+import itertools
+import json
 import os
+import re
+import subprocess
+import tempfile
+import time
+from functools import partial
+from glob import glob
 from multiprocessing import Pool
 
-import pandas as pd
-import textract
+import metrics
+from catalog import Catalog
+from jobs import Progress
+from supervised_pool import SupervisedPool, limit_memory
 from termcolor import colored
 
+# pages with fewer words are considered to lack a text layer
+PAGE_MIN_WORDS = 50
+
+# files with fewer words are considered to lack a text layer
+FILE_MIN_WORDS = 1000
+
+# maximum seconds to extract a file, or to run a command on a page
+EXTRACTION_TIMEOUT = 1800
+
+# maximum memory in megabytes of each extraction worker and the tools it runs
+EXTRACTION_MEMORY_MB = 4096
+
+# number of files after which an extraction worker is replaced
+FILES_PER_WORKER = 50
+
+# number of times a file that timed out or crashed its worker is retried
+EXTRACTION_RETRIES = 1
+
+
+# options of a page extraction worker, set when the worker process starts
+_page_options = None
+
+
+def _init_page_worker(memory_mb, allow_ocr, timeout):
+    """
+    Prepares a worker process for page extraction. Options are set once for
+    each worker, so page tasks only carry their page.
+
+    :param memory_mb: maximum memory in megabytes of the worker and the tools it runs
+    :param allow_ocr: whether to allow performing OCR on pages without text
+    :param timeout: maximum seconds to run a command on a page
+    """
+    global _page_options
+    _page_options = {"allow_ocr": allow_ocr, "timeout": timeout}
+    metrics.init_worker()
+    limit_memory(memory_mb)
+
+
+def _text_from_page(job):
+    """
+    Performs text extraction on a page of a pdf file in a worker process,
+    running OCR if the page has no text layer.
+
+    :param job: tuple with the path to the pdf file, page number and number of pages
+    :return: tuple with the job values, the page text, the extraction method and the error, or None if the extraction didn't fail
+    """
+    pdf_file, page, pages = job
+    timeout = _page_options["timeout"]
+    text = ""
+    method = "plain"
+    status = "failed"
+    error = None
+    start = time.perf_counter()
+    try:
+        text = _run(
+            ["pdftotext", "-f", str(page), "-l", str(page), pdf_file, "-"],
+            timeout,
+        )
+        # infers if the page has a text layer
+        if len(text.split()) < PAGE_MIN_WORDS and _page_options["allow_ocr"]:
+            txt = colored(f"Running OCR on {pdf_file} page {page}", "yellow")
+            print(txt)
+            text = _ocr_page(pdf_file, page, timeout)
+            method = "tesseract"
+        # tries to mitigate word breaks due to line breaks
+        text = text.replace("-\n", "").rstrip("\f")
+        status = "extracted"
+    except Exception as e:
+        print(colored(e, "red"))
+        error = repr(e)
+    metrics.EXTRACTED_PAGES.inc(method=method, status=status)
+    metrics.PAGE_EXTRACTION_SECONDS.observe(
+        time.perf_counter() - start, method=method
+    )
+    return pdf_file, page, pages, text, method, error
+
+
+def _ocr_page(pdf_file, page, timeout):
+    """
+    Performs OCR on a page of a pdf file.
+
+    :param pdf_file: path to the pdf file
+    :param page: page number
+    :param timeout: maximum seconds to run each command
+    :return: page text
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        _run(
+            [
+                "pdftoppm",
+                "-f",
+                str(page),
+                "-l",
+                str(page),
+                "-r",
+                "300",
+                "-png",
+                pdf_file,
+                f"{folder}/page",
+            ],
+            timeout,
+        )
+        image = glob(f"{folder}/page*.png")[0]
+        return _run(["tesseract", image, "stdout", "-l", "por"], timeout)
+
+
+def _run(args, timeout):
+    """
+    Runs an external command, killing it after the timeout.
+
+    :param args: command and its arguments
+    :param timeout: maximum seconds to run the command
+    :return: decoded output of the command
+    """
+    output = subprocess.run(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+        timeout=timeout,
+    )
+    return output.stdout.decode("utf-8")
+
 
 class TextFromPDF:
-    def __init__(self, documents_folder, index_folder):
+    def __init__(
+        self,
+        documents_folder,
+        index_folder,
+        timeout=EXTRACTION_TIMEOUT,
+        memory_mb=EXTRACTION_MEMORY_MB,
+        files_per_worker=FILES_PER_WORKER,
+        retries=EXTRACTION_RETRIES,
+    ):
         """
         Class responsible for extracting text from pdf files.
 
+        Every extraction writes a report of the files that failed, timed out
+        or crashed their worker to extraction_report.json in the index folder.
+
         :param documents_folder: path where files containing text from pdfs will be saved
         :param index_folder: path where the index will be created
+        :param timeout: maximum seconds to extract a file, or to run a command on a page, no limit if None
+        :param memory_mb: maximum memory in megabytes of each worker and the tools it runs, no limit if None
+        :param files_per_worker: number of files after which a worker is replaced
+        :param retries: number of times a file that timed out or crashed its worker is tried again
         """
+        self._timeout = timeout
+        self._memory_mb = memory_mb
+        self._files_per_worker = files_per_worker
+        self._retries = retries
         self._allow_ocr = False
-        self._existing = []
+        self._existing = set()
         self._paths = []
+        self._failures = []
         self._documents_folder = documents_folder
         self._index_folder = index_folder
         if not os.path.exists(f"{self._index_folder}"):
             os.mkdir(f"{self._index_folder}")
-            with open(f"{self._index_folder}/indexed_files.csv", "w") as f:
-                print("name,pdf_path,txt_path,indexed", file=f)
+        self._catalog = Catalog(self._index_folder)
 
-    def extract_text_from_pdfs(self, root, allow_ocr=False):
+    def extract_text_from_pdfs(
+        self, root, allow_ocr=False, by_page=False, progress=None, force=False
+    ):
         """
         Processes a batch of pdf files in a folder.
 
-        :param root: path to the pdf files to be processed
+        :param root: path to the pdf files to be processed, or a list of paths
         :param allow_ocr: whether to allow performing OCR on pdf files
+        :param by_page: whether to extract pages in parallel, running OCR only on pages without text
+        :param progress: receives the number of files processed
+        :param force: whether to extract files already registered
+        """
+        for _ in self.iter_text_from_pdfs(
+            root, allow_ocr, by_page, progress, force
+        ):
+            pass
+
+    def iter_text_from_pdfs(
+        self, root, allow_ocr=False, by_page=False, progress=None, force=False
+    ):
         """
-        self._prepare_for_extraction(root, allow_ocr)
-        os.environ["OMP_THREAD_LIMIT"] = "1"
-        Pool(os.cpu_count()).map(self._text_from_pdf, self._paths)
-        self._reset_state()
+        Processes a batch of pdf files in a folder, yielding each document as
+        soon as its text is saved.
+
+        :param root: path to the pdf files to be processed, or a list of paths
+        :param allow_ocr: whether to allow performing OCR on pdf files
+        :param by_page: whether to extract pages in parallel, running OCR only on pages without text
+        :param progress: receives the number of files processed
+        :param force: whether to extract files already registered
+        :return: generator of documents registered
+        """
+        progress = progress or Progress()
+        self._prepare_for_extraction(root, allow_ocr, force)
+        started = time.time()
+        files = len(self._paths)
+        try:
+            progress.start("extracted", len(self._paths))
+            # files with the same content are extracted only once
+            reused, duplicates = self._reuse_extractions(progress)
+            yield from reused
+            os.environ["OMP_THREAD_LIMIT"] = "1"
+            if by_page:
+                yield from self._text_from_pdfs_pages(progress)
+            else:
+                yield from self._text_from_pdfs_files(progress)
+            self._paths = list(duplicates)
+            reused, others = self._reuse_extractions(progress)
+            yield from reused
+            # copies left have the content of a file that wasn't extracted
+            for path in self._paths + list(others):
+                self._add_duplicate_failure(path, duplicates[path], progress)
+        finally:
+            self._write_report(started, files, allow_ocr, by_page)
+            self._reset_state()
+
+    def report(self):
+        """
+        Gets the report of the last extraction.
+
+        :return: dictionary with the files that failed, timed out or crashed, or None if there was no extraction
+        """
+        path = f"{self._index_folder}/extraction_report.json"
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _text_from_pdfs_files(self, progress):
+        """
+        Performs text extraction on every pdf file in supervised worker
+        processes, so files that hang or use too much memory don't stall the
+        others.
+
+        :param progress: receives the number of files processed
+        :return: generator of documents registered
+        """
+        pool = SupervisedPool(
+            os.cpu_count(),
+            timeout=self._timeout,
+            memory_mb=self._memory_mb,
+            tasks_per_worker=self._files_per_worker,
+            retries=self._retries,
+            initializer=metrics.init_worker,
+        )
+        with pool:
+            outcomes = pool.imap_unordered(
+                partial(metrics.collect, self._text_from_pdf), self._paths
+            )
+            for pdf_file, status, result, error, attempts in outcomes:
+                progress.advance("extracted")
+                if status == "done":
+                    # metrics recorded by workers arrive with the documents
+                    (document, error), values = result
+                    metrics.REGISTRY.merge(values)
+                    if error is None:
+                        if document:
+                            yield document
+                        continue
+                    status = "failed"
+                else:
+                    txt = f"Extraction of {pdf_file} {status}: {error}"
+                    print(colored(txt, "red"))
+                    metrics.EXTRACTED_FILES.inc(
+                        method="unknown", status=status
+                    )
+                self._add_failure(pdf_file, status, error, attempts=attempts)
 
     def _text_from_pdf(self, pdf_file):
         """
         Performs text extraction on a pdf file.
 
         :param pdf_file: path to the pdf file to be processed
+        :return: tuple with the document registered, or None if no valid text was extracted, and the error, or None if the extraction didn't fail
         """
+        # loaded by extraction workers only, keeping it out of the server
+        import textract
+
         print(f"Extracting from {pdf_file}")
+        start = time.perf_counter()
+        method = "plain"
+        status = "failed"
         try:
             # uses simple text extraction on file
             texts = textract.process(pdf_file)
             # infers if it was able to extract text from file
-            valid_text = len(texts.split()) > 1000
+            valid_text = self._has_words(texts, FILE_MIN_WORDS)
             if not valid_text:
                 # if text extraction was not successful and OCR is allowed
                 if self._allow_ocr:
                     txt = colored(f"Running OCR on {pdf_file}", "yellow")
                     print(txt)
+                    method = "tesseract"
                     texts = textract.process(
                         pdf_file, method="tesseract", lang="por"
                     )
                     valid_text = True
-            # decodes text to a readable format
+            # tries to mitigate word breaks due to line breaks, then decodes
+            # text to a readable format, in separate steps so no more than
+            # two copies of the output are held at once
+            texts = texts.replace(b"-\n", b"")
             texts = texts.decode("utf-8")
-            # tries to mitigate word breaks due to line breaks
-            texts = texts.replace("-\n", "")
-            name = pdf_file.split("/")[-1]
-            output_file = f"{self._documents_folder}/{name}.txt"
+            # keeps the extraction for files with the same content
+            file_hash = self._catalog.file_hash(pdf_file)
+            self._catalog.add_extraction(file_hash, texts, method, valid_text)
+            status = "valid" if valid_text else "invalid"
+            if valid_text:
+                return self._save_text(pdf_file, texts, file_hash), None
+        except Exception as e:
+            print(colored(e, "red"))
+            status = "failed"
+            return None, repr(e)
+        finally:
+            self._record_extraction(method, status, start)
+        return None, None
+
+    def _has_words(self, texts, count):
+        """
+        Checks if an extracted text has more than a number of words, without
+        splitting the whole text.
+
+        :param texts: extracted text, as bytes or str
+        :param count: number of words
+        :return: whether the text has more words
+        """
+        pattern = rb"\S+" if isinstance(texts, bytes) else r"\S+"
+        words = itertools.islice(re.finditer(pattern, texts), count + 1)
+        return sum(1 for _ in words) > count
+
+    def _record_extraction(self, method, status, start):
+        """
+        Records the outcome and duration of the extraction of a pdf file.
+
+        :param method: extraction method, plain or tesseract
+        :param status: outcome of the extraction, valid, invalid or failed
+        :param start: performance counter when the extraction started
+        """
+        metrics.EXTRACTED_FILES.inc(method=method, status=status)
+        metrics.EXTRACTION_SECONDS.observe(
+            time.perf_counter() - start, method=method
+        )
+
+    def _text_from_pdfs_pages(self, progress):
+        """
+        Performs text extraction on the pages of every pdf file, spreading
+        pages across the process pool and reassembling them in order.
+
+        :param progress: receives the number of files processed
+        :return: generator of documents registered
+        """
+        jobs = []
+        for pdf_file in self._paths:
+            try:
+                pages = self._count_pages(pdf_file)
+            except Exception as e:
+                print(colored(e, "red"))
+                metrics.EXTRACTED_FILES.inc(method="plain", status="failed")
+                self._add_failure(pdf_file, "failed", repr(e))
+                progress.advance("extracted")
+                continue
+            print(f"Extracting {pages} pages from {pdf_file}")
+            jobs.extend(
+                (pdf_file, page, pages) for page in range(1, pages + 1)
+            )
+        texts = []
+        methods = set()
+        # commands on pages are bounded by the timeout, while workers are
+        # replaced and limited in memory as in file extraction
+        pool = Pool(
+            os.cpu_count(),
+            initializer=_init_page_worker,
+            initargs=(self._memory_mb, self._allow_ocr, self._timeout),
+            maxtasksperchild=self._files_per_worker,
+        )
+        with pool:
+            # results arrive in the order of the jobs, so pages of a file
+            # are consecutive and the last page completes the file
+            for pdf_file, page, pages, text, method, error in metrics.merged(
+                pool.imap(partial(metrics.collect, _text_from_page), jobs)
+            ):
+                if error is not None:
+                    self._add_failure(pdf_file, "failed", error, page=page)
+                texts.append(text)
+                methods.add(method)
+                if page == pages:
+                    document = self._save_pages(pdf_file, texts, methods)
+                    progress.advance("extracted")
+                    if document:
+                        yield document
+                    texts = []
+                    methods = set()
+
+    def _save_pages(self, pdf_file, texts, methods):
+        """
+        Saves and registers the text extracted from the pages of a pdf file,
+        keeping page boundaries as form feeds.
+
+        :param pdf_file: path to the pdf file
+        :param texts: text of each page
+        :param methods: extraction methods used on the pages
+        :return: document registered, or None if no valid text was extracted
+        """
+        texts = "\f".join(texts)
+        method = "tesseract" if "tesseract" in methods else "plain"
+        valid_text = self._allow_ocr or self._has_words(texts, FILE_MIN_WORDS)
+        status = "valid" if valid_text else "invalid"
+        try:
+            file_hash = self._catalog.file_hash(pdf_file)
+            self._catalog.add_extraction(file_hash, texts, method, valid_text)
             if valid_text:
-                # if the text was extracted from the file, saves and register it
-                with open(f"{self._index_folder}/indexed_files.csv", "a") as f:
-                    print(f"{name},{pdf_file},{output_file},0", file=f)
-                with open(output_file, "w") as f:
-                    print(texts, file=f)
+                return self._save_text(pdf_file, texts, file_hash)
         except Exception as e:
             print(colored(e, "red"))
+            status = "failed"
+            self._add_failure(pdf_file, status, repr(e))
+        finally:
+            metrics.EXTRACTED_FILES.inc(method=method, status=status)
+        return None
+
+    def _count_pages(self, pdf_file):
+        """
+        Counts the pages of a pdf file.
+
+        :param pdf_file: path to the pdf file
+        :return: number of pages
+        """
+        for line in self._run(["pdfinfo", pdf_file]).splitlines():
+            if line.startswith("Pages:"):
+                return int(line.split()[-1])
+        raise ValueError(f"Unable to count pages of {pdf_file}")
+
+    def _run(self, args):
+        """
+        Runs an external command, killing it after the timeout.
+
+        :param args: command and its arguments
+        :return: decoded output of the command
+        """
+        return _run(args, self._timeout)
 
-    def _prepare_for_extraction(self, root, allow_ocr):
+    def _add_failure(self, pdf_file, status, error, **details):
+        """
+        Adds a file to the extraction report.
+
+        :param pdf_file: path to the pdf file
+        :param status: outcome of the extraction, failed, timeout or crashed
+        :param error: description of the error
+        :param details: additional values of the report entry, e.g. the page
+        """
+        entry = {"path": pdf_file, "status": status, "error": error}
+        entry.update(details)
+        self._failures.append(entry)
+
+    def _write_report(self, started, files, allow_ocr, by_page):
+        """
+        Writes the report of an extraction, replacing the previous one.
+
+        :param started: time when the extraction started
+        :param files: number of files to be processed
+        :param allow_ocr: whether OCR was allowed
+        :param by_page: whether pages were extracted in parallel
+        """
+        report = {
+            "started": started,
+            "finished": time.time(),
+            "files": files,
+            "ocr": allow_ocr,
+            "by_page": by_page,
+            "failures": self._failures,
+        }
+        path = f"{self._index_folder}/extraction_report.json"
+        # replaces the report at once, as it may be read during extractions
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def _save_text(self, pdf_file, texts, file_hash):
+        """
+        Saves and registers the text extracted from a pdf file.
+
+        :param pdf_file: path to the pdf file
+        :param texts: extracted text
+        :param file_hash: content hash of the pdf file
+        :return: document registered
+        """
+        name = pdf_file.split("/")[-1]
+        output_file = f"{self._documents_folder}/{name}.txt"
+        with open(output_file, "w") as f:
+            print(texts, file=f)
+        self._catalog.add(name, pdf_file, output_file, file_hash)
+        return {"name": name, "pdf_path": pdf_file, "txt_path": output_file}
+
+    def _reuse_extractions(self, progress):
+        """
+        Reuses text already extracted from files with the same content,
+        removing them from the files to be processed.
+
+        :param progress: receives the number of files processed
+        :return: documents registered and dictionary with the paths of files with the same content as another file to be processed, and the path of that file
+        """
+        reused = []
+        paths = []
+        duplicates = {}
+        hashes = {}
+        for path in self._paths:
+            try:
+                file_hash = self._catalog.file_hash(path)
+            except OSError as e:
+                print(colored(e, "red"))
+                self._add_failure(path, "failed", repr(e))
+                progress.advance("extracted")
+                continue
+            extraction = self._catalog.get_extraction(file_hash)
+            # text without enough words may still be extracted with OCR
+            if extraction and (extraction[2] or not self._allow_ocr):
+                texts, method, valid_text = extraction
+                print(f"Reusing {method} extraction for {path}")
+                metrics.EXTRACTED_FILES.inc(method=method, status="reused")
+                if valid_text:
+                    reused.append(self._save_text(path, texts, file_hash))
+                progress.advance("extracted")
+            elif file_hash in hashes:
+                duplicates[path] = hashes[file_hash]
+            else:
+                hashes[file_hash] = path
+                paths.append(path)
+        self._paths = paths
+        return reused, duplicates
+
+    def _add_duplicate_failure(self, pdf_file, original, progress):
+        """
+        Adds a file to the extraction report with the outcome of the file
+        with the same content, which wasn't extracted.
+
+        :param pdf_file: path to the pdf file
+        :param original: path to the file with the same content
+        :param progress: receives the number of files processed
+        """
+        status = "failed"
+        for failure in self._failures:
+            if failure["path"] == original:
+                status = failure["status"]
+        error = f"same content as {original}, which wasn't extracted"
+        print(colored(f"Extraction of {pdf_file} {status}: {error}", "red"))
+        metrics.EXTRACTED_FILES.inc(method="unknown", status=status)
+        self._add_failure(pdf_file, status, error)
+        progress.advance("extracted")
+
+    def _prepare_for_extraction(self, root, allow_ocr, force=False):
         """
         Updates class parameters for the text extraction process.
 
-        :param root: path to the pdf files to be processed
+        :param root: path to the pdf files to be processed, or a list of paths
         :param allow_ocr: whether to allow performing OCR on pdf files
+        :param force: whether to extract files already registered
         """
         self._allow_ocr = allow_ocr
-        if os.path.isdir(root):
+        if isinstance(root, list):
+            self._paths = list(root)
+        elif os.path.isdir(root):
             self._get_all_file_paths(root)
         else:
             self._paths = [root]
         self._get_existing_files()
+        if force:
+            return
         self._paths = [
             path for path in self._paths if path not in self._existing
         ]
@@ -92,19 +588,16 @@ class TextFromPDF:
     def _reset_state(self):
         """Resets class parameters after the text extraction process."""
         self._allow_ocr = False
-        self._existing = []
+        self._existing = set()
         self._paths = []
+        self._failures = []
 
     def _get_existing_files(self):
         """Excludes files already processed from new text extraction."""
         if not os.path.exists(self._documents_folder):
             os.mkdir(self._documents_folder)
         else:
-            self._existing = list(
-                pd.read_csv(f"{self._index_folder}/indexed_files.csv")[
-                    "pdf_path"
-                ].values
-            )
+            self._existing = self._catalog.pdf_paths()
 
     def _get_all_file_paths(self, path):
         """
@@ -0,0 +1,93 @@
+from collections import defaultdict
+
+
+def trigrams(word):
+    """
+    Gets the character trigrams of a word, marking its start and end.
+
+    :param word: word
+    :return: set of trigrams
+    """
+    padded = f"${word}$"
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Computes the Levenshtein distance between two words, giving up as soon
+    as it exceeds a maximum.
+
+    :param a: word
+    :param b: word
+    :param max_distance: maximum distance of interest
+    :return: distance, or None if it's greater than the maximum
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (ca != cb),
+                )
+            )
+        # distances only grow from one row to the next
+        if min(current) > max_distance:
+            return None
+        previous = current
+    distance = previous[-1]
+    return distance if distance <= max_distance else None
+
+
+class TrigramIndex:
+    def __init__(self, words):
+        """
+        Class responsible for finding the words of a vocabulary close to a
+        word, comparing only the words sharing enough character trigrams
+        with it.
+
+        :param words: vocabulary
+        """
+        self._words = list(words)
+        self._postings = defaultdict(list)
+        for i, word in enumerate(self._words):
+            for trigram in trigrams(word):
+                self._postings[trigram].append(i)
+
+    def __len__(self):
+        return len(self._words)
+
+    def similar(self, word, max_distance, limit):
+        """
+        Gets the words of the vocabulary within an edit distance of a word,
+        other than the word itself.
+
+        Each edit changes at most three trigrams, so words sharing fewer
+        trigrams can't be close enough. Words sharing no trigram at all are
+        never found, so short words should be given a small distance.
+
+        :param word: word
+        :param max_distance: maximum edit distance
+        :param limit: maximum number of words
+        :return: list of tuples with the distance and the word, closest first
+        """
+        grams = trigrams(word)
+        shared = defaultdict(int)
+        for trigram in grams:
+            for i in self._postings.get(trigram, ()):
+                shared[i] += 1
+        min_shared = max(len(grams) - 3 * max_distance, 1)
+        found = []
+        for i, count in shared.items():
+            candidate = self._words[i]
+            if count < min_shared or candidate == word:
+                continue
+            distance = edit_distance(word, candidate, max_distance)
+            if distance is not None:
+                found.append((distance, candidate))
+        found.sort()
+        return found[:limit]